@@ -1,14 +1,178 @@
 import numpy as np
 import glob
+import os
+import re
+import sys
 import sqlite3
+import itertools
+import candidates
 
-con = sqlite3.connect("2016.sql") #2016.sql is an example, change it if necessary
-cur = con.cursor()
-cur.execute("CREATE TABLE 'lwa1' (snr FLOAT, dm FLOAT, time_tag FLOAT, resolution FLOAT)")
-fn = sorted(glob.glob('*.txt'))
-for i in fn:
-    t=np.loadtxt(i)
-    print 'doing', i
-    [cur.execute("""INSERT INTO 'lwa1' (snr, dm, time_tag, resolution) VALUES (?,?,?,?)""", (j[1], j[2], j[3], j[4])) for j in t]
+database = "2016.sql" #2016.sql is an example, change it if necessary
+table    = 'lwa1'
+patterns = ['ppc_SNR_*.txt', 'ppc_SNR_*.cand'] #text candidate files and binary candidate stores of dv.py, or give the files on the command line
+rtree    = False #True = also keep an R*Tree on (time_tag, dm) for range queries
+chunk    = 200000 #rows per executemany
+tiling   = True #keep the (time, DM) density tiles that web.py draws wide queries from
+tbin     = 1.0 #time bin (s) of the finest tiles, every level doubles it
+dmbin    = 1.0 #DM bin (pc cm^-3) of the finest tiles, every level doubles it
+nlevels  = 8 #number of tile levels
+snredges = np.array([0, 5, 6, 7, 8, 9, 10, 12, 15, 20, 30, 50, 100]) #S/N bands of the tiles
 
-con.commit()#Do not forget this!!
+#columns of the candidate table, the first four are the ones web.py queries
+columns = [('snr', 'FLOAT'), ('dm', 'FLOAT'), ('time_tag', 'FLOAT'), ('resolution', 'FLOAT'), ('pulse', 'INTEGER'),
+           ('dnu', 'FLOAT'), ('nu', 'FLOAT'), ('mean', 'FLOAT'), ('rms', 'FLOAT'),
+           ('pol', 'INTEGER'), #0 = lower tunning, 1 = higher tunning
+           ('td', 'INTEGER'),  #index of the pulse width searched (the td_<i> of the file name)
+           ('file', 'INTEGER')] #id in the files table
+#candidate columns (see candidates.py) that go into the table columns above
+fromcand = [('snr', 'SNR'), ('dm', 'DM'), ('time_tag', 'time'), ('resolution', 'dtau'), ('pulse', 'pulse'),
+            ('dnu', 'dnu'), ('nu', 'nu'), ('mean', 'mean'), ('rms', 'rms')]
+
+
+def connect(database):
+    con = sqlite3.connect(database)
+    cur = con.cursor()
+    #write ahead log and fewer syncs, a crash can lose the last transaction but never corrupts the file
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-200000") #200 MB
+    return con
+
+
+def create(con):
+    """
+    Create the tables, or add the missing columns to a table made by an older SQL.py,
+    which only had snr, dm, time_tag and resolution.
+    """
+    cur = con.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS '%s' (%s)" % (table, ', '.join('%s %s' % c for c in columns)))
+    have = [row[1] for row in cur.execute("PRAGMA table_info('%s')" % table)]
+    for name, kind in columns:
+        if name not in have:
+            cur.execute("ALTER TABLE '%s' ADD COLUMN %s %s" % (table, name, kind))
+    #every file that has been loaded and how many of its candidates, for incremental appends
+    cur.execute("CREATE TABLE IF NOT EXISTS 'files' (id INTEGER PRIMARY KEY, name TEXT UNIQUE, size INTEGER, rows INTEGER)")
+    #number of candidates and their highest S/N per time bin, DM bin, resolution and S/N band at every
+    #level, and the bin sizes of the levels with the last row of the candidate table they include
+    cur.execute("CREATE TABLE IF NOT EXISTS 'tiles' (level INTEGER, tb INTEGER, db INTEGER, resolution FLOAT, snrlow FLOAT, count INTEGER, maxsnr FLOAT, PRIMARY KEY (level, tb, db, resolution, snrlow)) WITHOUT ROWID")
+    cur.execute("CREATE TABLE IF NOT EXISTS 'tilelevels' (level INTEGER PRIMARY KEY, tbin FLOAT, dmbin FLOAT, lastrow INTEGER)")
+    con.commit()
+
+
+def index(con):
+    """
+    Build the indexes once the candidates are in, so that the range queries of web.py do not scan
+    the whole table.
+    """
+    cur = con.cursor()
+    cur.execute("CREATE INDEX IF NOT EXISTS '%s_time' ON '%s' (time_tag, dm, snr, resolution)" % (table, table))
+    cur.execute("CREATE INDEX IF NOT EXISTS '%s_dm' ON '%s' (dm, time_tag)" % (table, table))
+    cur.execute("CREATE INDEX IF NOT EXISTS '%s_snr' ON '%s' (snr)" % (table, table))
+    cur.execute("CREATE INDEX IF NOT EXISTS '%s_file' ON '%s' (file)" % (table, table))
+    if rtree:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS '%s_rtree' USING rtree(id, tmin, tmax, dmmin, dmmax)" % table)
+        last = cur.execute("SELECT max(id) FROM '%s_rtree'" % table).fetchone()[0]
+        cur.execute("INSERT INTO '%s_rtree' SELECT rowid, time_tag, time_tag, dm, dm FROM '%s' WHERE rowid > ?" % (table, table), (last or 0,))
+    cur.execute("ANALYZE")
+    con.commit()
+
+
+def tiles(con):
+    """
+    Add the candidates that are not in the tiles yet to every level, or build all the tiles again if
+    candidates were removed or the bin sizes changed.
+    """
+    cur = con.cursor()
+    levels = [(level, tbin*2**level, dmbin*2**level) for level in range(nlevels)]
+    if cur.execute("SELECT level, tbin, dmbin FROM 'tilelevels' ORDER BY level").fetchall() != levels:
+        cur.execute("DELETE FROM 'tiles'")
+        cur.execute("DELETE FROM 'tilelevels'")
+        cur.executemany("INSERT INTO 'tilelevels' VALUES (?, ?, ?, 0)", levels)
+    last = cur.execute("SELECT min(lastrow) FROM 'tilelevels'").fetchone()[0]
+    upsert = "INSERT INTO 'tiles' VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (level, tb, db, resolution, snrlow) DO UPDATE SET count = count+excluded.count, maxsnr = max(maxsnr, excluded.maxsnr)"
+    while True:
+        cur.execute("SELECT rowid, snr, dm, time_tag, resolution FROM '%s' WHERE rowid > ? ORDER BY rowid LIMIT ?" % table, (last, chunk))
+        rows = np.fromiter(itertools.chain.from_iterable(cur), dtype=np.float64).reshape(-1, 5)
+        if len(rows) == 0:
+            break
+        last = int(rows[-1, 0])
+        snrlow = snredges[np.searchsorted(snredges, rows[:, 1], side='right')-1]
+        for level, tb, db in levels:
+            keys = np.array([np.floor(rows[:, 3]/tb), np.floor(rows[:, 2]/db), rows[:, 4], snrlow]).T
+            keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+            order = np.argsort(inverse, kind='mergesort')
+            count = np.bincount(inverse, minlength=len(keys))
+            maxsnr = np.maximum.reduceat(rows[order, 1], np.r_[0, np.cumsum(count)[:-1]])
+            cur.executemany(upsert, [(level, int(t), int(d), r, b, n, m) for (t, d, r, b), n, m in zip(keys.tolist(), count.tolist(), maxsnr.tolist())])
+        cur.execute("UPDATE 'tilelevels' SET lastrow = ?", (last,))
+        con.commit()
+
+
+def filesize(name):
+    #a candidate store grows by its column files, a text file by itself
+    if os.path.isdir(name):
+        pulsefile = os.path.join(name, 'pulse.bin')
+        return os.path.getsize(pulsefile) if os.path.exists(pulsefile) else 0
+    return os.path.getsize(name)
+
+
+def ingest(con, name):
+    """
+    Load the candidates of one text file or candidate store.  A file seen before is skipped if it
+    has not changed.  If a store has grown only its new candidates are added, a text file that
+    changed is loaded again.  Returns the number of rows added.
+    """
+    cur = con.cursor()
+    size = filesize(name)
+    row = cur.execute("SELECT id, size, rows FROM 'files' WHERE name = ?", (name,)).fetchone()
+    first = 0
+    if row is not None:
+        fileid, oldsize, oldrows = row
+        if oldsize == size:
+            return 0
+        if os.path.isdir(name) and size > oldsize:
+            first = oldrows
+        else:
+            cur.execute("DELETE FROM '%s' WHERE file = ?" % table, (fileid,))
+            cur.execute("DELETE FROM 'tilelevels'") #the tiles are built again from the start
+    else:
+        cur.execute("INSERT INTO 'files' (name, size, rows) VALUES (?, ?, 0)", (name, size))
+        fileid = cur.lastrowid
+
+    if os.path.isdir(name):
+        cand = candidates.read_candidates(name, [c for t, c in fromcand])
+    else:
+        t = candidates.load_table(name)
+        cand = np.zeros(len(t), dtype=candidates.schema)
+        for i, column in enumerate(candidates.columns):
+            cand[column] = t[:, i]
+    m = re.search(r'pol_(\d+)', os.path.basename(name))
+    pol = int(m.group(1)) if m else None
+    m = re.search(r'td_(\d+)', os.path.basename(name))
+    td = int(m.group(1)) if m else None
+
+    sql = "INSERT INTO '%s' (%s) VALUES (%s)" % (table, ', '.join(c for c, k in columns), ', '.join('?'*len(columns)))
+    for start in xrange(first, len(cand), chunk):
+        block = cand[start:start+chunk]
+        rows = zip(*([block[c].tolist() for t, c in fromcand]+[[pol]*len(block), [td]*len(block), [fileid]*len(block)]))
+        cur.executemany(sql, rows)
+    cur.execute("UPDATE 'files' SET size = ?, rows = ? WHERE id = ?", (size, len(cand), fileid))
+    con.commit() #one transaction per file
+    return len(cand)-first
+
+
+def main(args):
+    fn = args if len(args) > 0 else sorted(sum([glob.glob(p) for p in patterns], []))
+    con = connect(database)
+    create(con)
+    for i in fn:
+        print 'doing', i, ':', ingest(con, i), 'new candidates'
+    if tiling:
+        tiles(con)
+    index(con)
+    con.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
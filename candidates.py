@@ -0,0 +1,220 @@
+"""
+Binary columnar store for the single pulse candidates of dv.py.
+
+A store is a directory, e.g. ppc_SNR_pol_1_td_00_rank_000.cand, with a
+'schema' text file that lists the columns and their numpy types and one
+raw little-endian file per column (pulse.bin, SNR.bin, ...).  Candidates
+are appended in blocks, and a reader only has to load the columns it
+needs, with a single np.fromfile per column.  The columns are the same as
+those of the ppc_SNR_*.txt files: pulse, SNR, DM, time, dtau, dnu, nu,
+mean, rms.
+
+Run as a script to convert text candidate files into a store:
+
+    python candidates.py store.cand ppc_SNR_pol_1_td_00_no_00001.txt ...
+"""
+
+import os
+import sys
+import numpy as np
+
+# column name and type, in the order of the text files
+schema = [('pulse', '<i8'), ('SNR', '<f4'), ('DM', '<f8'), ('time', '<f8'), ('dtau', '<f4'),
+          ('dnu', '<f4'), ('nu', '<f4'), ('mean', '<f4'), ('rms', '<f4')]
+columns = [name for name, dtype in schema]
+
+
+def read_schema(name):
+    """
+    Return the [(column, dtype), ...] schema of the store name.
+    """
+    fh = open(os.path.join(name, 'schema'))
+    out = [tuple(line.split()) for line in fh if line.strip()]
+    fh.close()
+    return out
+
+
+class CandidateWriter(object):
+    """
+    Appends candidates to the store name, which is created if it does not
+    exist.  Candidates are kept in memory until bufsize of them are waiting
+    and are then appended to every column file at once.  Pulse numbers
+    carry on from the ones already in the store.  The first column of a
+    schema other than the default one has to be the pulse number too.  A
+    store left by a flush that was cut short has columns of different
+    lengths; they are all cut to the candidates every column has, so the
+    new ones line up.
+    """
+
+    def __init__(self, name, bufsize=100000, schema=schema):
+        self.name = name
+        self.bufsize = bufsize
+        self.schema = schema
+        if not os.path.isdir(name):
+            os.makedirs(name)
+        if not os.path.exists(os.path.join(name, 'schema')):
+            fh = open(os.path.join(name, 'schema'), 'w')
+            for column, dtype in schema:
+                fh.write('%s %s\n' % (column, dtype))
+            fh.close()
+        self.npulse = self.complete()
+        self.buffer = []
+        self.nbuffer = 0
+
+    def complete(self):
+        """
+        Cut every column file to the number of candidates all of them have
+        and return that number.
+        """
+        names = [os.path.join(self.name, column+'.bin') for column, dtype in self.schema]
+        sizes = [np.dtype(dtype).itemsize for column, dtype in self.schema]
+        n = min(os.path.getsize(filename)//size if os.path.exists(filename) else 0
+                for filename, size in zip(names, sizes))
+        for filename, size in zip(names, sizes):
+            if os.path.exists(filename) and os.path.getsize(filename) != n*size:
+                fh = open(filename, 'r+b')
+                fh.truncate(n*size)
+                fh.close()
+        return n
+
+    def append(self, *values):
+        """
+        Add a batch of candidates, e.g. append(SNR, DM, time, dtau, dnu, nu,
+        mean, rms), one argument for every column of the schema after the
+        pulse number.  Every argument is an array with a value per candidate
+        or a single value shared by all of them.
+        """
+        block = np.broadcast_arrays(*values)
+        n = len(block[0])
+        if n == 0:
+            return
+        pulse = np.arange(self.npulse+self.nbuffer+1, self.npulse+self.nbuffer+n+1)
+        self.buffer.append([pulse]+block)
+        self.nbuffer += n
+        if self.nbuffer >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the buffered candidates to the column files.
+        """
+        if self.nbuffer == 0:
+            return
+        for i, (column, dtype) in enumerate(self.schema):
+            values = np.concatenate([block[i] for block in self.buffer]).astype(dtype)
+            fh = open(os.path.join(self.name, column+'.bin'), 'ab')
+            values.tofile(fh)
+            fh.close()
+        self.npulse += self.nbuffer
+        self.buffer = []
+        self.nbuffer = 0
+
+    def close(self):
+        self.flush()
+
+
+def read_candidates(name, columns=None):
+    """
+    Read the store name.  If a write was cut short and the columns have
+    different lengths, only the candidates that are complete are returned.
+    Options:
+    columns - list of the columns to read.  default = all of them.
+    Returns a numpy structured array with a field for every column.
+    """
+    types = dict(read_schema(name))
+    if columns is None:
+        columns = [column for column, dtype in read_schema(name)]
+    values = {}
+    for column in columns:
+        filename = os.path.join(name, column+'.bin')
+        if os.path.exists(filename):
+            values[column] = np.fromfile(filename, dtype=types[column])
+        else:
+            values[column] = np.zeros(0, dtype=types[column])
+    n = min(len(v) for v in values.values())
+    out = np.zeros(n, dtype=[(column, types[column]) for column in columns])
+    for column in columns:
+        out[column] = values[column][:n]
+    return out
+
+
+def read_text(filename):
+    """
+    Read a ppc_SNR_*.txt candidate file with the fast numpy text parser
+    instead of np.loadtxt.  Returns a (n, 9) float array in the column
+    order of the file.
+    """
+    values = np.fromfile(filename, sep=' ')
+    return values.reshape(-1, len(schema))
+
+
+def load_table(name):
+    """
+    Read a store or a text candidate file into the (n, 9) float array that
+    np.loadtxt gives for a text file, for the scripts that index columns.
+    """
+    if os.path.isdir(name):
+        cand = read_candidates(name)
+        return np.array([cand[column] for column in columns], dtype=np.float64).T
+    return read_text(name)
+
+
+def iter_table(name, columns=None, chunk=1000000):
+    """
+    Read a store or a text candidate file chunk candidates at a time, so a
+    file larger than memory can be reduced as it is read.
+    Options:
+    columns - list of the columns to read.  default = all of them.
+    chunk   - candidates per chunk (roughly, for a text file).
+              default = 1000000.
+    Yields (n, len(columns)) float arrays in the order of the file.
+    """
+    names = [column for column, dtype in schema]
+    if columns is None:
+        columns = names
+    if os.path.isdir(name):
+        types = dict(read_schema(name))
+        files = []
+        for column in columns:
+            filename = os.path.join(name, column+'.bin')
+            size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            files.append(np.memmap(filename, dtype=types[column], mode='r') if size > 0 else np.zeros(0))
+        n = min(len(f) for f in files)
+        for start in xrange(0, n, chunk):
+            yield np.array([f[start:min(start+chunk, n)] for f in files], dtype=np.float64).T
+        return
+    index = [names.index(column) for column in columns]
+    fh = open(name)
+    while True:
+        lines = fh.readlines(chunk*100) # ~100 characters a line
+        if len(lines) == 0:
+            break
+        yield np.fromstring(''.join(lines), sep=' ').reshape(-1, len(schema))[:, index]
+    fh.close()
+
+
+def convert_text(name, filenames):
+    """
+    Append the candidates of the text files, in order, to the store name.
+    The pulses are numbered again, continuing the store.  Returns the
+    number of candidates converted.
+    """
+    writer = CandidateWriter(name)
+    total = 0
+    for filename in filenames:
+        t = read_text(filename)
+        writer.append(*[t[:, i] for i in range(1, len(schema))])
+        total += len(t)
+    writer.close()
+    return total
+
+
+def main(args):
+    if len(args) < 2:
+        print 'usage: python candidates.py store.cand file.txt [file.txt ...]'
+        sys.exit(1)
+    print 'converted', convert_text(args[0], args[1:]), 'candidates into', args[0]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,9 +6,14 @@ import sys
 import numpy
 import getopt
 import drx
+import errors
+import spectrometer
+import fftbackend
 import time
+import manifest
+import workqueue
+import spectrogram
 import matplotlib.pyplot as plt
-import glob
 
 
 def Decimate_ts(ts, ndown=2):
@@ -40,83 +45,73 @@ def Decimate_ts(ts, ndown=2):
 
 
 def main(args):
-        totalrank = 12
-	nodes = 2
-	pps = 6
         comm  = MPI.COMM_WORLD
         rank  = comm.Get_rank()
 	t0 = time.time()
 	nChunks = 10000 #the temporal shape of a file.
 	LFFT = 4096 #Length of the FFT.4096 is the size of a frame readed.
 	nFramesAvg = 1*4*LFFT/4096 # the intergration time under LFFT, 4 = beampols = 2X + 2Y (high and low tunes)
+	nBlock = 100 # number of chunks transformed together by the spectrometer engine
+	fftBackend = None # 'numpy', 'scipy', 'fftw' or None to use the fastest one available
+	fftWorkers = 1 # FFT threads per rank
+	prefetch = 2 # chunks queued ahead on every worker rank, see workqueue.py
+	container = True # True = redo the chunks in the <data file>_waterfall.npy container of waterfall.py (spectrogram.py) with its nChunks and LFFT, False = one .npy per chunk with the settings above
 
-	fn = sorted(glob.glob('waterfall05*.npy'))
-	j = numpy.zeros((len(fn)))
-	for i in range(len(fn)):
-		j[i] = fn[i][39:48]
+	# Map the DRX file once.  The header probing is done a single time and 
+	# all of the ranks share the page cache for the read-only mapping.
+	try:
+		idf = drx.DRXFile(getopt.getopt(args,':')[1][0])
+	except (IOError, OSError):
+		print getopt.getopt(args,':')[1][0],' not found'
+		sys.exit(1)
+	nFramesFile = idf.nFrames
+	srate = idf.sampleRate
+	if srate is None:
+		print 'zero division error'
+		sys.exit(1)
+	beam = idf.beam
+	beampols = idf.beampols
+	centralFreq1 = idf.centralFreq1
+	centralFreq2 = idf.centralFreq2
+	if nChunks == 0:
+		nChunks = 1
+	containerName = None
+	if container:
+		containerName = spectrogram.containerName(getopt.getopt(args,':')[1][0], 'waterfall')
+		spec = spectrogram.SpectrogramFile(containerName, mode='r+')
+		# The chunks are redone the way waterfall.py (or multift.py) wrote the
+		# container: one mean spectrum of all of the channels per slab, LFFT
+		# from the channels and nChunks from tInt
+		if spec.rowsPerSlab != 1:
+			raise ValueError("%s has %i spectra per chunk, not one mean spectrum" % (containerName, spec.rowsPerSlab))
+		LFFT = spec.data.shape[2]+1
+		nChunks = int(round(spec.tInt*srate/LFFT))
+		nFramesAvg = 1*4*LFFT/4096
+		for freq, centralFreq in ((spec.freq1, centralFreq1), (spec.freq2, centralFreq2)):
+			if spectrometer.channelWindow(freq-centralFreq, LFFT, srate) != (0, LFFT-1):
+				raise ValueError("%s does not have all of the channels of a %i point FFT" % (containerName, LFFT))
+		if len(spec.offsets) > 1 and (numpy.diff(spec.offsets) % (nFramesAvg*nChunks)).any():
+			raise ValueError("The chunks of %s are not on a grid of %i frames" % (containerName, nFramesAvg*nChunks))
+	nFrames = nFramesAvg*nChunks
+	engine = spectrometer.Spectrometer(LFFT, [(0, LFFT-1), (0, LFFT-1)], nBlock=nBlock, framesPerChunk=nFramesAvg, backend=fftbackend.getBackend(fftBackend, workers=fftWorkers))
+	# Every chunk saved is recorded in the run manifest of the stage, see manifest.py
+	runManifest = manifest.Manifest(manifest.manifestName(getopt.getopt(args,':')[1][0], 'waterfall'))
 
-	#x = total perfect offset
-	x = numpy.arange(j[-1]/nChunks/nFramesAvg)*nChunks*nFramesAvg
-	# k = the different between perfect and real
-	k = numpy.setdiff1d(x, j)
-
-	for m in xrange(len(k)/totalrank):
-		#print 'offset = ',k[m*totalrank + rank]
+	# k = the offsets, on the grid of nChunks*nFramesAvg frames up to the last 
+	# one recorded, that waterfall.py has not saved or that failed.  Rank 0 
+	# hands them out to the other ranks as they finish their last one.
+	k = None
+	if rank == 0:
+		if container:
+			# the chunks of the container that are not saved or failed
+			done = runManifest.completed(name=containerName)
+			k = [int(offset) for offset in spec.offsets if offset not in done]
+		else:
+			k = [int(offset) for offset in runManifest.missing(nChunks*nFramesAvg)]
 
 	#for offset_i in range(4306, 4309):# one offset = nChunks*nFramesAvg skiped
 	#for offset_i in range(100, 1000 ):# one offset = nChunks*nFramesAvg skiped
-                #offset_i = 1.*totalrank*offset_i + rank
-		#offset = nChunks*nFramesAvg*offset_i
-		offset = k[m*totalrank + rank]
-		# Build the DRX file
-		try:
-                        fh = open(getopt.getopt(args,':')[1][0], "rb")
-                        nFramesFile = os.path.getsize(getopt.getopt(args,':')[1][0]) / drx.FrameSize #drx.FrameSize = 4128
-		except:
-			print getopt.getopt(args,':')[1][0],' not found'
-			sys.exit(1)
-		try:
-			junkFrame = drx.readFrame(fh)
-			try:
-				srate = junkFrame.getSampleRate()
-				pass
-			except ZeroDivisionError:
-				print 'zero division error'
-				break
-		except errors.syncError:
-			print 'assuming the srate is 19.6 MHz'
-			fh.seek(-drx.FrameSize+1, 1)
-		fh.seek(-drx.FrameSize, 1)
-		beam,tune,pol = junkFrame.parseID()
-		beams = drx.getBeamCount(fh)
-		tunepols = drx.getFramesPerObs(fh)
-		tunepol = tunepols[0] + tunepols[1] + tunepols[2] + tunepols[3]
-		beampols = tunepol
-		if offset != 0:
-			fh.seek(offset*drx.FrameSize, 1)
-		if nChunks == 0:
-			nChunks = 1
-		nFrames = nFramesAvg*nChunks
-		centralFreq1 = 0.0
-		centralFreq2 = 0.0
-		for i in xrange(4):
-			junkFrame = drx.readFrame(fh)
-			b,t,p = junkFrame.parseID()
-			if p == 0 and t == 0:
-				try:
-					centralFreq1 = junkFrame.getCentralFreq()
-				except AttributeError:
-					from dp import fS
-					centralFreq1 = fS * ((junkFrame.data.flags[0]>>32) & (2**32-1)) / 2**32
-			elif p == 0 and t == 2:
-				try:
-					centralFreq2 = junkFrame.getCentralFreq()
-				except AttributeError:
-					from dp import fS
-					centralFreq2 = fS * ((junkFrame.data.flags[0]>>32) & (2**32-1)) / 2**32
-			else:
-				pass
-		fh.seek(-4*drx.FrameSize, 1)
+	def transform(offset):
 		# Sanity check
 		if nFrames > (nFramesFile - offset):
 			raise RuntimeError("Requested integration time + offset is greater than file length")
@@ -129,51 +124,26 @@ def main(args):
 		freq2 = freq+centralFreq2
 		#print tInt,freq1.mean(),freq2.mean()
 		masterSpectra = numpy.zeros((nChunks, 2, LFFT-1))
-		for i in xrange(nChunks):
-			# Find out how many frames remain in the file.  If this number is larger
-			# than the maximum of frames we can work with at a time (nFramesAvg),
-			# only deal with that chunk
-			framesRemaining = nFrames - i*nFramesAvg
-			if framesRemaining > nFramesAvg:
-				framesWork = nFramesAvg
-			else:
-				framesWork = framesRemaining
-			#if framesRemaining%(nFrames/10)==0:
-			#	print "Working on chunk %i, %i frames remaining" % (i, framesRemaining)
-			count = {0:0, 1:0, 2:0, 3:0}
-			data = numpy.zeros((4,framesWork*4096/beampols), dtype=numpy.csingle)
-			# If there are fewer frames than we need to fill an FFT, skip this chunk
-			if data.shape[1] < LFFT:
-				print 'data.shape[1]< LFFT, break'
-				break
-			# Inner loop that actually reads the frames into the data array
-			for j in xrange(framesWork):
-				# Read in the next frame and anticipate any problems that could occur
-				try:
-					cFrame = drx.readFrame(fh, Verbose=False)
-				except errors.eofError:
-					print "EOF Error"
-					break
-				except errors.syncError:
-					print "Sync Error"
-					continue
-				beam,tune,pol = cFrame.parseID()
-				if tune == 0:
-					tune += 1
-				aStand = 2*(tune-1) + pol
-				data[aStand, count[aStand]*4096:(count[aStand]+1)*4096] = cFrame.data.iq
-				count[aStand] +=  1
-			# Calculate the spectra for this block of data
-			masterSpectra[i,0,:] = ((numpy.fft.fftshift(numpy.abs(numpy.fft.fft2(data[:2,:]))[:,1:]))**2.).mean(0)/LFFT/2. #in unit of energy
-			masterSpectra[i,1,:] = ((numpy.fft.fftshift(numpy.abs(numpy.fft.fft2(data[2:,:]))[:,1:]))**2.).mean(0)/LFFT/2. #in unit of energy
-			# Save the results to the various master arrays
-			#print masterSpectra.shape
-			#numpy.save('data',data)
-			#sys.exit()
-			#if i % 100 ==1 :
-			#	print i, ' / ', nChunks
+		# Compute the spectra, in the unit of energy, for all of the chunks 
+		# in blocks of nBlock chunks with one batched FFT per block
+		tChunk = time.time()
+		status = manifest.statusOK
+		try:
+			engine.process(idf, offset, nChunks, out=masterSpectra)
+		except errors.eofError:
+			print "EOF Error"
+			status = 'eof'
                 outname = "%s_%i_fft_offset_%.9i_frames" % (getopt.getopt(args,':')[1][0], beam,offset)
-		numpy.save('waterfall' + outname, masterSpectra.mean(0) )
+		meanSpectrum = masterSpectra.mean(0)
+		if container:
+			savedName = spec.save(offset, meanSpectrum)
+		else:
+			savedName = manifest.atomicSave('waterfall' + outname, meanSpectrum )
+		runManifest.record(offset, nFrames, status, manifest.checksum(meanSpectrum), time.time()-tChunk, savedName)
+	workqueue.distribute(comm, k, transform, prefetch=prefetch)
+	# Rank 0 is the last one to finish, every chunk of the run is recorded by now
+	if container and rank == 0:
+		spec.setValid(runManifest.completed(name=containerName))
 	#print time.time()-t0
 	#print masterSpectra.shape
 	#print masterSpectra.shape
@@ -0,0 +1,463 @@
+"""
+Dedispersion engines used by dv.py.
+
+The spectrogram is kept channel-major, i.e. with shape (channels, time bins),
+so that the samples one channel contributes to a dedispersed time series at a
+given delay are contiguous in memory and on disk.
+"""
+
+import os
+import sys
+import json
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def delay_table(freq, DMs, tInt):
+    """
+    Calculate the integer delay, in time bins, of every channel for every DM
+    trial w.r.t. the highest frequency.  This is round(delay2(freq, DM)/tInt)
+    from dv.py done for all of the DM trials at once.
+    Required:
+    freq - 1-D array of frequencies in MHz
+    DMs  - 1-D array of Dispersion Measures in pc cm-3
+    tInt - temporal resolution of the spectrogram in seconds
+    Returns a (nDM, nchan) int32 array.
+    """
+    # Dispersion constant in MHz^2 s / pc cm^-3
+    _D = 4.148808e3
+    DMs = np.atleast_1d(np.asarray(DMs, dtype=np.float64))
+    tDelay = np.outer(DMs*_D, (1/freq)**2 - (1/freq.max())**2)
+
+    return np.round(tDelay/tInt).astype(np.int32)
+
+
+def dm_plan(freq, DMs, tInt, planfile=None):
+    """
+    Drop the DM trials whose integer delay vector is identical to that of an
+    earlier trial, since they give exactly the same dedispersed time series.
+    At low frequencies with a coarse tInt neighbouring trials often round to
+    the same delays in every channel.  If planfile is given the plan is saved
+    there as a .npz file together with freq, tInt and the requested DMs, and
+    is loaded from it instead of recomputed as long as those three match.
+    Required:
+    freq     - 1-D array of frequencies in MHz
+    DMs      - 1-D array of the requested DM trials in pc cm-3
+    tInt     - temporal resolution of the spectrogram in seconds
+    Options:
+    planfile - .npz file to keep the plan in.  default = None, not saved.
+    Returns (DMs, delays), the DM trials that are kept, in their original
+    order, and their (nDM, nchan) delay_table.
+    """
+    freq = np.asarray(freq, dtype=np.float64)
+    DMs = np.atleast_1d(np.asarray(DMs, dtype=np.float64))
+    if planfile is not None and os.path.exists(planfile):
+        plan = np.load(planfile)
+        same = plan['freq'].shape == freq.shape and (plan['freq'] == freq).all() \
+           and plan['tInt'] == tInt and plan['requested'].shape == DMs.shape \
+           and (plan['requested'] == DMs).all()
+        if same:
+            DMs_kept, delays = plan['DMs'], plan['delays']
+        plan.close()
+        if same:
+            return DMs_kept, delays
+
+    delays = delay_table(freq, DMs, tInt)
+    # first trial of every distinct delay vector, in the original order
+    keep = np.sort(np.unique(delays, axis=0, return_index=True)[1])
+    DMs_kept, delays = DMs[keep], delays[keep]
+
+    if planfile is not None:
+        # write under a temporary name so that a reader never sees half a plan
+        tmpname = '%s.%i.npz' % (planfile, os.getpid())
+        np.savez(tmpname, freq=freq, tInt=tInt, requested=DMs, DMs=DMs_kept, delays=delays)
+        os.rename(tmpname, planfile)
+
+    return DMs_kept, delays
+
+
+def create_channel_major(outname, nchan, nt, dtype=np.float32):
+    """
+    Create an empty channel-major spectrogram of shape (nchan, nt) as a .npy
+    file that can be memory mapped and filled by several processes.
+    Required:
+    outname - name of the .npy file
+    nchan   - number of frequency channels
+    nt      - number of time bins
+    Options:
+    dtype   - data type of the stored spectrogram.  default = float32.
+    """
+    if os.path.exists(_marker_name(outname)):#a new file is not complete until it is marked again
+        os.remove(_marker_name(outname))
+    cm = np.lib.format.open_memmap(outname, mode='w+', dtype=dtype, shape=(nchan, nt))
+    del cm
+
+
+def fill_channel_major(outname, spect, tstart):
+    """
+    Write a (time, channel) block of spectrogram into the channel-major file
+    outname starting at time bin tstart.
+    Required:
+    outname - channel-major .npy file made by create_channel_major
+    spect   - (nt, nchan) spectrogram block, e.g. one massaged ft.py file
+    tstart  - time bin of the first row of spect
+    """
+    cm = np.load(outname, mmap_mode='r+')
+    cm[:, tstart:tstart+spect.shape[0]] = spect.T
+    cm.flush()
+    del cm
+
+
+def _marker_name(outname):
+    return os.path.splitext(outname)[0] + '.json'
+
+
+def mark_channel_major(outname, source):
+    """
+    Record that the channel-major file outname is complete, after every
+    process has filled its part of it, in the .json marker next to it.
+    Required:
+    outname - channel-major .npy file made by create_channel_major
+    source  - dict of what it was made from (numbers, strings and lists),
+              e.g. the spectrogram file, its size, pol and channels
+    """
+    tmpname = "%s.tmp%i" % (_marker_name(outname), os.getpid())
+    fh = open(tmpname, 'w')
+    try:
+        json.dump(source, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    finally:
+        fh.close()
+    os.rename(tmpname, _marker_name(outname))
+
+
+def channel_major_ready(outname, source):
+    """
+    True if the channel-major file outname is complete and was made from
+    source (see mark_channel_major), False if it is missing, was left half
+    filled by a run that did not finish or was made from something else.
+    """
+    if not os.path.exists(outname) or not os.path.exists(_marker_name(outname)):
+        return False
+    fh = open(_marker_name(outname))
+    try:
+        marked = json.load(fh)
+    except ValueError:
+        return False
+    finally:
+        fh.close()
+    return marked == json.loads(json.dumps(source))
+
+
+def _window_view(row, start, span, nout, buf):
+    """
+    Copy input bins start .. start+span+nout-1 of one channel into buf, with
+    zeros for the bins outside of the channel, and return a (span+1, nout)
+    strided view of it whose row d holds bins start+d .. start+d+nout-1.
+    """
+    nt = row.shape[0]
+    n = span+nout
+    buf[:n] = 0
+    a = max(start, 0)
+    b = min(start+n, nt)
+    if b > a:
+        buf[a-start:b-start] = row[a:b]
+    step = buf.strides[0]
+    return as_strided(buf, shape=(span+1, nout), strides=(step, step))
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _dedisperse_numba(cm, delays, t0, ts, tile):
+        nDM, nchan = delays.shape
+        nt = cm.shape[1]
+        nout = ts.shape[1]
+        # the output is done in tiles of time bins that stay in cache while
+        # every channel is added to them, in channel order
+        for t1 in range(0, nout, tile):
+            t2 = min(t1+tile, nout)
+            for chan in range(nchan):
+                for k in range(nDM):
+                    start = t0+delays[k, chan]
+                    a = max(t1, -start)
+                    b = min(t2, nt-start)
+                    for t in range(a, b):
+                        ts[k, t] += cm[chan, start+t]
+
+
+def dedisperse_block(cm, delays, t0, nout, tile=1024, use_numba=None):
+    """
+    Brute force dedispersion of the output bins t0 .. t0+nout-1 for a batch of
+    DM trials.  Output bin t of a DM trial is the sum over channels of
+    cm[chan, t+delay[chan]], which is the same as the tstotal series of dv.py
+    after the dispersed time lag has been cut off.  The output is done in
+    tiles of tile bins that stay in cache.  Within a tile the loop only runs
+    over the channels: the contiguous input window a channel needs for the
+    whole batch is viewed as a (delay spread+1, tile) strided array and the
+    rows of all the DM trials are gathered and added in one go.  If numba is
+    installed the same loop is compiled instead.  Channels are added in
+    order either way, so the sums are the same as adding them one by one.
+    Input bins outside of cm, before 0 or after its end, contribute nothing,
+    so t0 can be negative.
+    Required:
+    cm        - (nchan, nt) channel-major spectrogram, may be a memmap
+    delays    - (nDM, nchan) integer delays from delay_table
+    t0        - first output time bin
+    nout      - number of output time bins
+    Options:
+    tile      - output bins per tile.  default = 1024.
+    use_numba - True/False to force the numba kernel on/off.  default = use
+                numba when it can be imported.
+    Returns a (nDM, nout) array.
+    """
+    nDM, nchan = delays.shape
+    ts = np.zeros((nDM, nout))
+    if use_numba is None:
+        use_numba = numba is not None
+    if use_numba:
+        _dedisperse_numba(np.asarray(cm), np.ascontiguousarray(delays), t0, ts, tile)
+        return ts
+
+    lo = delays.min(0)
+    span = delays.max(0)-lo
+    buf = np.zeros(span.max()+tile)
+    tmp = np.empty((nDM, tile))
+    for t1 in range(0, nout, tile):
+        n = min(tile, nout-t1)
+        for chan in range(nchan):
+            view = _window_view(cm[chan], t0+t1+lo[chan], span[chan], n, buf)
+            np.take(view, delays[:, chan]-lo[chan], axis=0, out=tmp[:, :n])
+            ts[:, t1:t1+n] += tmp[:, :n]
+
+    return ts
+
+
+def valid_length(delays, nt):
+    """
+    Number of output bins of each DM trial that have data in every channel,
+    i.e. nt - max delay, which is the length of tstotal in dv.py.
+    """
+    return nt - delays.max(1)
+
+
+def stream_dedisperse(cm, delays, tstart=0, tstop=None, blocksize=2**16, dmbatch=32):
+    """
+    Generator that walks the output time range tstart .. tstop-1 in blocks of
+    blocksize bins and yields the dedispersed time series of dmbatch DM trials
+    at a time.  Each block only reads its own bins plus the dispersion delay
+    that follows them, so the peak memory depends on blocksize, nchan and
+    dmbatch but not on the length of the observation.
+    Required:
+    cm        - (nchan, nt) channel-major spectrogram, usually a memmap
+    delays    - (nDM, nchan) integer delays from delay_table
+    Options:
+    tstart    - first output bin.  default = 0.
+    tstop     - end of the output range.  default = nt - smallest max delay.
+    blocksize - output bins per block.  default = 2**16.
+    dmbatch   - DM trials per block.  default = 32.
+    Yields (t0, kDM, ts, nvalid, down) where kDM are the indices of the DM
+    trials in delays, ts is the (len(kDM), nout) block of dedispersed time
+    series, nvalid[k] is the number of bins of row k inside the valid length
+    of that DM trial and down, the number of input bins per bin of ts, is
+    always 1 (see stream_fdmt).
+    """
+    nt = cm.shape[1]
+    nvalid = valid_length(delays, nt)
+    if tstop is None:
+        tstop = nvalid.max()
+
+    for t0 in range(tstart, tstop, blocksize):
+        nout = min(blocksize, tstop-t0)
+        for b in range(0, delays.shape[0], dmbatch):
+            kDM = np.arange(b, min(b+dmbatch, delays.shape[0]))
+            keep = nvalid[kDM] > t0
+            if not keep.any():
+                continue
+            kDM = kDM[keep]
+            ts = dedisperse_block(cm, delays[kDM], t0, nout)
+            yield t0, kDM, ts, np.clip(nvalid[kDM]-t0, 0, nout), 1
+
+
+def fdmt_memory(nchan, nt, spread):
+    """
+    Bytes fdmt holds, about, for a (nchan, nt) block and DM trials whose
+    largest delays are at most spread bins apart: the float64 input and the
+    rows of the subbands of two merge levels, no more than about spread+nchan
+    rows each (the subbands of a level have that many distinct partial
+    delays).
+    """
+    return 8*nt*(nchan+2*(spread+nchan))
+
+
+def fdmt(block, delays, maxmemory=None):
+    """
+    Fast Dispersion Measure Transform (Zackay & Ofek 2017) of a channel-major
+    block.  Rather than summing every channel for every DM trial, pairs of
+    neighbouring subbands are merged log2(nchan) times, and every merge
+    combines the partial sums of the two halves for all of the DM trials at
+    once.  The partial delays of a subband are the delays of the trials
+    less the delay of its highest channel, so the delays of the two halves
+    and the shift between them add up to exactly the delays of the trial,
+    and a subband only keeps one row for every distinct set of partial
+    delays (many trials share them in the narrow subbands).  This takes
+    about O(nt x (maxdelay+nchan) x log2(nchan)) for all the DM trials
+    instead of O(nDM x nchan x nt).
+    Row k of the result is the same as that of dedisperse_block(block,
+    delays, 0, nt), i.e. out[k, t] = sum over channels of
+    block[chan, t+delays[k, chan]], with zeros for the input bins beyond the
+    end of the block.
+    Required:
+    block    - (nchan, nt) channel-major spectrogram
+    delays   - (nDM, nchan) integer delays from delay_table
+    Options:
+    maxmemory - bytes the transform may hold (see fdmt_memory), a MemoryError
+                is raised before anything is allocated if it needs more.
+                default = None, no limit.
+    Returns a (nDM, nt) array.
+    """
+    nchan, nt = block.shape
+    delays = np.asarray(delays, dtype=np.int64)
+    spread = np.ptp(delays.max(1))
+    if maxmemory is not None and fdmt_memory(nchan, nt, spread) > maxmemory:
+        raise MemoryError("The FDMT of %i channels x %i bins with delays %i bins apart needs about %.3g GB, more than the %.3g GB allowed"
+                          % (nchan, nt, spread, fdmt_memory(nchan, nt, spread)/2.**30, maxmemory/2.**30))
+
+    # start with every channel being a subband of its own, which has a single
+    # row; subbands are kept as (lowest channel, highest channel, row of
+    # every DM trial, rows)
+    single = np.zeros(delays.shape[0], dtype=np.int64)
+    subbands = [(c, c, single, np.asarray(block[c:c+1], dtype=np.float64)) for c in range(nchan)]
+
+    while len(subbands) > 1:
+        merged = []
+        for i in range(0, len(subbands)-1, 2):
+            alo, ahi, arow, A = subbands[i]     # lower frequencies
+            blo, bhi, brow, B = subbands[i+1]   # higher frequencies
+            # the distinct partial delays of the merged subband, and one trial
+            # that has each of them
+            partial = delays[:, alo:bhi+1]-delays[:, bhi:bhi+1]
+            unique, first, row = np.unique(partial, axis=0, return_index=True, return_inverse=True)
+            rows = np.empty((len(unique), nt))
+            for r, k in enumerate(first):
+                off = delays[k, ahi]-delays[k, bhi] # shift of the lower half
+                rows[r] = B[brow[k]]
+                if off < nt:
+                    rows[r, :nt-off] += A[arow[k], off:]
+            merged.append((alo, bhi, row.ravel(), rows))
+        if len(subbands) % 2 == 1:
+            merged.append(subbands[-1])
+        subbands = merged
+
+    lo, hi, row, rows = subbands[0]
+    out = rows[row]
+    # the partial delays are from the highest channel, which has no delay
+    # unless the delays are not measured from it
+    for k in np.nonzero(delays[:, hi])[0]:
+        shift = delays[k, hi]
+        out[k, :max(nt-shift, 0)] = out[k, shift:].copy()
+        out[k, max(nt-shift, 0):] = 0
+    return out
+
+
+def stream_fdmt(cm, delays, freq, tstart=0, tstop=None, blocksize=2**16, dmbatch=32, maxdelay=2048, maxmemory=2**33):
+    """
+    Same as stream_dedisperse, but every block is dedispersed for all DM
+    trials at once with fdmt, which gives the same time series as
+    dedisperse_block.  A DM trial whose dispersion smears a pulse over
+    several bins even in the highest channel is dedispersed from the block
+    decimated by the largest power of two (the mean of every down bins)
+    that is not wider than that smearing, and its time series is given at
+    that resolution: a pulse at that DM is at least that wide, so the
+    boxcars of down bins or more find it as well as at the full resolution
+    (the decimated bins are those boxcars), and the narrower ones need not
+    be searched.  The DM trials of a decimation are done in passes of at
+    most maxdelay (decimated) bins of delay from the smallest to the largest
+    of a pass.  A pass reads blocksize bins plus its largest delay and holds
+    about fdmt_memory(nchan, (blocksize+delay)/down, maxdelay) bytes; if one
+    needs more than maxmemory a MemoryError is raised before any block is
+    read.
+    Required:
+    cm        - (nchan, nt) channel-major spectrogram, usually a memmap
+    delays    - (nDM, nchan) integer delays from delay_table
+    freq      - 1-D array of the channel frequencies in MHz, ascending
+    Options:
+    tstart, tstop, blocksize, dmbatch - see stream_dedisperse, tstart and
+                blocksize have to be multiples of the decimations for the
+                decimated bins to be boxcars of the whole time series
+    maxdelay  - largest spread of the delays, in (decimated) bins, of one
+                pass.  default = 2048.
+    maxmemory - bytes one pass may hold.  default = 8 GB.
+    Yields (t0, kDM, ts, nvalid, down) like stream_dedisperse, with ts and
+    nvalid in bins of down bins.
+    """
+    nchan, nt = cm.shape
+    nvalid = valid_length(delays, nt)
+    if tstop is None:
+        tstop = nvalid.max()
+    rows = delays.max(1)
+    # decimation of every DM trial, the largest power of two not wider than
+    # the smearing in the highest channel, which divides the blocks
+    invf2 = (1./np.asarray(freq, dtype=np.float64))**2
+    smear = rows*(invf2[-2]-invf2[-1])/(invf2[0]-invf2[-1]) if nchan > 1 else np.zeros(len(rows))
+    ndown = np.ones(len(rows), dtype=int)
+    while True:
+        wider = (2*ndown <= smear) & (blocksize % (2*ndown) == 0) & (tstart % (2*ndown) == 0)
+        if not wider.any():
+            break
+        ndown[wider] *= 2
+    # passes of trials with the same decimation and delays in the same span of maxdelay bins
+    passes = []
+    prows = np.round(rows/ndown.astype(float)).astype(int)
+    for down, span in sorted(set(zip(ndown, prows//maxdelay))):
+        kpass = np.where((ndown == down) & (prows//maxdelay == span))[0]
+        nin = -(-(blocksize+down*prows[kpass].max())//down)
+        if fdmt_memory(nchan, nin, np.ptp(prows[kpass])) > maxmemory:
+            raise MemoryError("The FDMT of blocks of %i bins, decimated by %i, with delays of %i to %i bins needs about %.3g GB, more than the %.3g GB allowed: use a smaller blocksize or maxdelay"
+                              % (blocksize, down, prows[kpass].min(), prows[kpass].max(), fdmt_memory(nchan, nin, np.ptp(prows[kpass]))/2.**30, maxmemory/2.**30))
+        passes.append((down, kpass))
+
+    for t0 in range(tstart, tstop, blocksize):
+        nout = min(blocksize, tstop-t0)
+        for down, kpass in passes:
+            k = kpass[nvalid[kpass] > t0]
+            if len(k) == 0:
+                continue
+            # the block and the largest delay of the pass, decimated, with
+            # zeros past the end of the spectrogram
+            pdelays = np.round(delays[k]/float(down)).astype(int)
+            nin = -(-nout//down)+pdelays.max()
+            block = np.asarray(cm[:, t0:t0+nin*down], dtype=np.float64)
+            if block.shape[1] < nin*down:
+                block = np.concatenate((block, np.zeros((nchan, nin*down-block.shape[1]))), axis=1)
+            if down > 1:
+                block = block.reshape(nchan, nin, down).mean(2)
+            out = fdmt(block, pdelays)
+            for b in range(0, len(k), dmbatch):
+                yield t0, k[b:b+dmbatch], out[b:b+dmbatch, :-(-nout//down)], \
+                    np.clip((nvalid[k[b:b+dmbatch]]-t0)//down, 0, -(-nout//down)), down
+
+
+if __name__ == '__main__':
+    # Check fdmt against dedisperse_block: a pulse of one bin dispersed at a
+    # few DMs across the 64-83.6 MHz band of dv.py has to come out whole at
+    # its time in both, and so does noise
+    freq = np.linspace(64, 83.6, 835)
+    tInt = 16384/19.6e6
+    delays = delay_table(freq, [0, 2, 5, 10], tInt)
+    block = np.random.standard_normal((len(freq), 512+delays.max()))
+    for k in range(len(delays)):
+        block[np.arange(len(freq)), 100*(k+1)+delays[k]] += 100
+    out = fdmt(block, delays)
+    brute = dedisperse_block(block, delays, 0, block.shape[1])
+    for k in range(len(delays)):
+        print 'delay %5i bins: pulse %.1f channels in fdmt, %.1f in dedisperse_block' \
+            % (delays[k].max(), out[k, 100*(k+1)]/100., brute[k, 100*(k+1)]/100.)
+    print 'largest difference', np.abs(out-brute).max()
+    if not np.allclose(out, brute):
+        sys.exit(1)
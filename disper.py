@@ -9,6 +9,7 @@ import math
 import re
 import matplotlib.pyplot as plt
 from scipy.optimize import fsolve
+from scipy.special import erf
 
 #return the dispersed time (sec) accross two frequencies in MHz
 def dispersion_t_sec(DM, nuLowMHz, nuHighMHz):
@@ -32,19 +33,29 @@ def snrratio(dDM, W_ms, freq_centeral_GHz, Bandwidth_MHz):
     return S_delatDM_vs_S_ratio(k)
 
 
-#return dDM
+#return the kersci value (eq. 13) at which the S/S ratio of eq. (12) drops to ssratio,
+#found by bisection since sqrt(pi)/2*erf(k)/k falls monotonically from 1 at k=0.
+#ssratio can be an array.
+def kersci_root(ssratio, niter=60):
+    ssratio = np.asarray(ssratio, dtype=np.float64)
+    if ((ssratio <= 0) | (ssratio >= 1)).any():
+        raise ValueError("ssratio must be between 0 and 1")
+    lo = np.zeros(ssratio.shape)
+    hi = np.ones(ssratio.shape)
+    #sqrt(pi)/2/k bounds the ratio from above, so k = 1/ssratio is always past the root
+    hi = hi/ssratio
+    for i in range(niter):
+        mid = 0.5*(lo+hi)
+        above = np.sqrt(np.pi)/2.*erf(mid)/mid > ssratio
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+    return 0.5*(lo+hi)
+
+#return dDM, the closed form of kersci (eq. 13) solved for deltaDM at the kersci_root of ssratio.
+#works on arrays of W_ms (and the other arguments) too.
 def dDMi(ssratio, W_ms, freq_centeral_GHz, Bandwidth_MHz):
-    #dDM = 1000.
-    for dDM in (0.01, 0.1, 1, 10, 100, 1000):
-        #print dDM, snrratio(dDM, W_ms, freq_centeral_GHz, Bandwidth_MHz), '1', ssratio , '2'
-        if snrratio(dDM, W_ms, freq_centeral_GHz, Bandwidth_MHz) > ssratio: continue
-        else:
-            while snrratio(dDM, W_ms, freq_centeral_GHz, Bandwidth_MHz) < ssratio:
-                dDM -= 0.001
-                #if dDM<0.001:return dDM
-            return dDM
-    return 1001
-    
+    return kersci_root(ssratio)*np.asarray(W_ms)*np.asarray(freq_centeral_GHz)**3/(6.91*10**(-3)*np.asarray(Bandwidth_MHz))
+
 def cal_snrratio(DM, dDM, W_ms, freq_centeral_GHz, Bandwidth_MHz, channels, tInt_sec):
     w_ms = np.array([W_ms, 10.**3*dispersion_t_sec(DM, freq_centeral_GHz*10**3-Bandwidth_MHz/channels, freq_centeral_GHz*10**3+Bandwidth_MHz/channels), tInt_sec]).max()
     #print  '\n', 'un_disperse_able_width_ms', w_ms#, 10.**3*dispersion_t_sec(DM, freq_centeral_GHz*10**3-0.5*Bandwidth_MHz, freq_centeral_GHz*10**3-0.5*Bandwidth_MHz+Bandwidth_MHz/channels),'\n'
@@ -56,6 +67,35 @@ def cal_dDMi(ssratio, DM, W_ms, freq_centeral_GHz, Bandwidth_MHz, channels, tInt
     #print  '\n', 'un_disperse_able_width_ms', w_ms#, 10.**3*dispersion_t_sec(DM, freq_centeral_GHz*10**3-0.5*Bandwidth_MHz, freq_centeral_GHz*10**3-0.
     return dDMi(ssratio, w_ms, freq_centeral_GHz, Bandwidth_MHz)
 
+#return the effective pulse width in ms of every DM (array) and intrinsic width W_ms (array),
+#the largest of the intrinsic width, the dispersion smearing of the channels and the time resolution
+def effective_width_ms(DM, W_ms, freq_centeral_GHz, Bandwidth_MHz, channels, tInt_sec):
+    smear_ms = 10.**3*dispersion_t_sec(np.asarray(DM, dtype=np.float64), freq_centeral_GHz*10**3-Bandwidth_MHz/channels, freq_centeral_GHz*10**3+Bandwidth_MHz/channels)
+    return np.maximum(np.maximum(np.asarray(W_ms, dtype=np.float64), smear_ms), 10.**3*tInt_sec)
+
+#return the DM trials from DMstart to the first one past DMend, where each step is the dDM of
+#cal_dDMi, i.e. the neighbouring trial keeps at least ssratio of the S/N.  widths_ms are the
+#intrinsic pulse widths searched, the narrowest one sets the step.
+def dm_grid(DMstart, DMend, ssratio, freq_centeral_GHz, Bandwidth_MHz, channels, tInt_sec, widths_ms=0.):
+    #dDM = k*effective width
+    k = kersci_root(ssratio)*freq_centeral_GHz**3/(6.91*10**(-3)*Bandwidth_MHz)
+    #smearing per unit DM across the channels in ms
+    a = 10.**3*dispersion_t_sec(1., freq_centeral_GHz*10**3-Bandwidth_MHz/channels, freq_centeral_GHz*10**3+Bandwidth_MHz/channels)
+    w0 = max(np.min(widths_ms), 10.**3*tInt_sec)
+
+    #below DMcross the smearing is less than w0 and the step is the constant k*w0, above it
+    #the step is k*a*DM, so the trials are spaced geometrically by a factor of 1+k*a
+    DMcross = w0/a
+    DMtrials = np.array([float(DMstart)])
+    if DMstart < DMcross:
+        n = int(np.ceil((min(DMcross, DMend)-DMstart)/(k*w0)))
+        DMtrials = DMstart + k*w0*np.arange(n+1)
+    DM = DMtrials[-1]
+    if DM < DMend:
+        n = int(np.ceil(np.log(1.*DMend/DM)/np.log(1.+k*a)))
+        DMtrials = np.append(DMtrials, DM*(1.+k*a)**np.arange(1, n+1))
+    return DMtrials
+
 
 def main(args):
 
@@ -14,10 +14,28 @@ from errors import *
 
 __version__ = '0.3'
 __revision__ = '$ Revision: 15 $'
-__all__ = ['FrameHeader', 'FrameData', 'Frame', 'ObservingBlock', 'readFrame', 'readBlock', 'getBeamCount', 'getFramesPerObs', 'averageObservations', 'averageObservations2', 'FrameSize', 'filterCodes', '__version__', '__revision__', '__all__']
+__all__ = ['FrameHeader', 'FrameData', 'Frame', 'ObservingBlock', 'DRXFile', 'readFrame', 'readFrames', 'readBlock', 'decodeIQ', 'parseIDs', 'getFrameCounts', 'fillStands', 'fillChunks', 'getBeamCount', 'getFramesPerObs', 'averageObservations', 'averageObservations2', 'FrameSize', 'FrameDtype', 'SyncWord', 'filterCodes', '__version__', '__revision__', '__all__']
 
 FrameSize = 4128
 
+# Mark 5C sync word as it appears in the first four bytes of every frame
+SyncWord = 0xDEC0DE5C
+
+# Layout of a complete DRX frame (header+data) for bulk reads.  The 24-bit 
+# frame count shares its 32-bit word with the DRX ID, so the 'frameCount' 
+# field overlaps 'drxID' and has to be masked with getFrameCounts.
+FrameDtype = numpy.dtype({'names': ['syncWord', 'drxID', 'frameCount', 'secondsCount', 'decimation', 'timeOffset', 'timeTag', 'flags', 'payload'], 
+					'formats': ['>u4', 'u1', '>u4', '>u4', '>u2', '>u2', '>u8', '>u8', ('u1', 4096)], 
+					'offsets': [0, 4, 4, 8, 12, 14, 16, 24, 32], 
+					'itemsize': FrameSize})
+
+# Look-up table that maps a packed 4+4 bit byte onto its signed I/Q sample
+_iqLUT = numpy.zeros(256, dtype=numpy.complex64)
+_iqLUT.real = (numpy.arange(256)>>4)&15
+_iqLUT.imag = numpy.arange(256)&15
+_iqLUT.real[_iqLUT.real >= 8] -= 16
+_iqLUT.imag[_iqLUT.imag >= 8] -= 16
+
 # List of filter codes and their corresponding sample rates in Hz
 filterCodes = {1: 250000, 2: 500000, 3: 1000000, 4: 2000000, 5: 4000000, 6: 9800000, 7: 19600000}
 
@@ -119,7 +137,132 @@ class ObservingBlock(object):
 		self.y1 = y1
 		self.x2 = x2
 		self.y2 = y2
+
+
+class DRXFile(object):
+	"""Class that memory maps a DRX recording so that frames can be accessed 
+	by index without buffered reads.  The file is exposed both as a 
+	(nFrames, FrameSize) uint8 array ('raw') and as a FrameDtype record array 
+	('frames') whose fields are lazy views into the mapping.  The beam and 
+	tuning/polarization layout is probed once when the file is opened.  Since 
+	the mapping is read-only, every MPI rank that opens the same file shares 
+	the operating system's page cache for it."""
+	
+	def __init__(self, filename, Verbose=False):
+		self.filename = filename
+		self.nFrames = os.path.getsize(filename) / FrameSize
+		if self.nFrames == 0:
+			raise eofError()
+		
+		self.raw = numpy.memmap(filename, dtype=numpy.uint8, mode='r', shape=(self.nFrames, FrameSize))
+		self.frames = self.raw.view(FrameDtype)[:,0]
+		self.Verbose = Verbose
+		
+		self.__probeLayout()
+		
+	def __probeLayout(self, nProbe=16):
+		"""Private function to find the beams, tuning/polarization ID codes, 
+		sample rate and central frequencies from the first 'nProbe' frames.  
+		This replaces the getBeamCount and getFramesPerObs calls which re-read 
+		the start of the file every time."""
+		
+		probe = self.frames[:nProbe]
+		probe = probe[probe['syncWord'] == SyncWord]
+		if probe.shape[0] == 0:
+			raise syncError()
+		
+		drxIDs = probe['drxID']
+		beam, tune, pol = parseIDs(drxIDs)
+		self.beams = sorted(set(beam.tolist()))
+		self.beam = self.beams[0]
+		
+		idCodes = [[], [], [], []]
+		for cID, b in zip(drxIDs.tolist(), beam.tolist()):
+			if cID not in idCodes[b-1]:
+				idCodes[b-1].append(cID)
+		self.tunepols = tuple([len(codes) for codes in idCodes])
+		self.beampols = sum(self.tunepols)
+		
+		decimation = probe['decimation'][0]
+		if decimation == 0:
+			self.sampleRate = None
+		else:
+			self.sampleRate = dp_common.fS / decimation
+		
+		tuningWords = (probe['flags']>>32) & (2**32-1)
+		self.centralFreq1 = 0.0
+		self.centralFreq2 = 0.0
+		for t, p, word in zip(tune.tolist(), pol.tolist(), tuningWords.tolist()):
+			if p == 0 and t == 0:
+				self.centralFreq1 = dp_common.fS * word / 2**32
+			elif p == 0 and t == 2:
+				self.centralFreq2 = dp_common.fS * word / 2**32
+		
+		self.tStart = probe['timeTag'][0] / dp_common.fS
+		
+	def __len__(self):
+		return self.nFrames
 		
+	def __getitem__(self, key):
+		"""Index or slice the frames by frame number.  Returns FrameDtype 
+		record(s) which still point into the mapping."""
+		
+		return self.frames[key]
+		
+	def getHeaders(self, start=0, stop=None):
+		"""Return the header fields for frames start through stop-1 as a lazy 
+		FrameDtype view.  Only the pages actually touched are read."""
+		
+		return self.frames[start:stop]
+		
+	def getPayloads(self, start=0, stop=None):
+		"""Return the raw (frames, 4096) uint8 payloads for frames start 
+		through stop-1 as a view into the mapping."""
+		
+		return self.raw[start:stop, 32:]
+		
+	def readFrames(self, start, count, dropBad=True):
+		"""Return 'count' decoded frames starting at frame index 'start' in 
+		the same (frames, iq) form as the module level readFrames function.  
+		If 'dropBad' is False frames with bad sync words are kept so that 
+		the position of each frame in the returned arrays matches its 
+		position in the file; fillChunks skips them."""
+		
+		if start >= self.nFrames:
+			raise eofError()
+		
+		return _decodeFrames(self.frames[start:start+count], dropBad=dropBad, Verbose=self.Verbose)
+		
+	def getTime(self, index):
+		"""Return the time in seconds since station midnight of the frame at 
+		'index'."""
+		
+		return self.frames['timeTag'][index] / dp_common.fS
+		
+	def findTime(self, t):
+		"""Return the index of the first frame whose time is at or after 't' 
+		seconds since station midnight.  The frames are assumed to be in time 
+		order, so this is a binary search that touches only log2(nFrames) 
+		pages of the file."""
+		
+		timeTag = t * dp_common.fS
+		lo, hi = 0, self.nFrames
+		while lo < hi:
+			mid = (lo + hi) / 2
+			if self.frames['timeTag'][mid] < timeTag:
+				lo = mid + 1
+			else:
+				hi = mid
+				
+		# Back up to the start of the tuning/polarization group
+		return lo - (lo % self.beampols)
+		
+	def sliceByTime(self, t0, t1):
+		"""Return a slice object covering the frames between t0 and t1 
+		seconds from the start of the recording."""
+		
+		return slice(self.findTime(self.tStart + t0), self.findTime(self.tStart + t1))
+
 
 def __readHeader(filehandle, Verbose=False):
 	"""Private function to read in a DRX header.  Returns a FrameHeader object."""
@@ -230,6 +373,113 @@ def readFrame(filehandle, Verbose=False):
 	return newFrame
 
 
+def decodeIQ(payload):
+	"""Function to convert packed 4-bit I/Q bytes into complex samples.  Any 
+	array shape is accepted and a complex64 array of the same shape is 
+	returned."""
+	
+	return _iqLUT[payload]
+
+
+def parseIDs(drxID):
+	"""Vectorized version of FrameHeader.parseID that works on an array of 
+	DRX IDs.  Returns a tuple of beam, tuning, and polarization arrays."""
+	
+	drxID = numpy.asarray(drxID)
+	beam = drxID&7
+	tune = (drxID>>3)&7 - 1
+	pol  = (drxID>>7)&1
+	
+	return (beam, tune, pol)
+
+
+def getFrameCounts(frames):
+	"""Return the 24-bit frame counts of an array of FrameDtype records."""
+	
+	return frames['frameCount'] & 0xFFFFFF
+
+
+def readFrames(filehandle, count, Verbose=False):
+	"""Function to read in up to 'count' DRX frames with a single read.  
+	Returns a two-element tuple of the FrameDtype record array holding the 
+	headers and raw payloads and a (frames, 4096) complex64 array of the 
+	decoded I/Q samples.  Frames with a bad sync word are dropped, the same 
+	way readFrame callers skip them after a syncError.  An eofError is 
+	raised if no complete frame could be read."""
+	
+	frames = numpy.fromfile(filehandle, dtype=FrameDtype, count=count)
+	if frames.shape[0] == 0 and count > 0:
+		raise eofError()
+	
+	return _decodeFrames(frames, Verbose=Verbose)
+
+
+def _decodeFrames(frames, dropBad=True, Verbose=False):
+	"""Private function to drop frames with bad sync words from a FrameDtype 
+	array and decode the remaining payloads.  Returns a (frames, iq) tuple."""
+	
+	good = (frames['syncWord'] == SyncWord)
+	if dropBad and not good.all():
+		if Verbose:
+			print "Dropping %i frames with bad sync words" % (good.size - good.sum())
+		frames = frames[good]
+	
+	return frames, decodeIQ(frames['payload'])
+
+
+def fillStands(frames, iq, data):
+	"""Function to sort decoded frames into the (4, N) tuning/polarization 
+	array 'data' using the aStand = 2*(tune-1) + pol ordering of the FFT 
+	stages.  Frames are placed in file order and any frames that do not fit 
+	are ignored.  Returns the number of frames placed in each stand."""
+	
+	beam, tune, pol = parseIDs(frames['drxID'])
+	tune = numpy.where(tune == 0, 1, tune)
+	aStand = 2*(tune-1) + pol
+	
+	nMax = data.shape[1] / 4096
+	counts = []
+	for stand in xrange(data.shape[0]):
+		cIQ = iq[aStand == stand][:nMax]
+		data[stand, :cIQ.shape[0]*4096] = cIQ.ravel()
+		counts.append(cIQ.shape[0])
+		
+	return counts
+
+
+def fillChunks(frames, iq, data, framesPerChunk):
+	"""Block version of fillStands.  The frames are split into consecutive 
+	groups of 'framesPerChunk' frames and each group is sorted into its own 
+	row of the (chunks, 4, N) array 'data'.  'frames' and 'iq' should come 
+	from DRXFile.readFrames with dropBad=False so that a frame's chunk can be 
+	found from its position; frames with bad sync words are skipped, leaving 
+	zeros behind, the same as the per-frame loop did.  Returns a (chunks, 4) 
+	array with the number of frames placed in each chunk and stand."""
+	
+	nChunks, nStands = data.shape[0], data.shape[1]
+	nMax = data.shape[2] / 4096
+	
+	beam, tune, pol = parseIDs(frames['drxID'])
+	tune = numpy.where(tune == 0, 1, tune)
+	aStand = 2*(tune-1) + pol
+	chunk = numpy.arange(frames.shape[0]) / framesPerChunk
+	
+	good = (frames['syncWord'] == SyncWord) & (chunk < nChunks) & (aStand < nStands)
+	
+	# Number each frame within its (chunk, stand) group in file order
+	key = chunk*nStands + aStand
+	key[~good] = -1
+	order = numpy.argsort(key, kind='mergesort')
+	sortedKey = key[order]
+	slot = numpy.empty_like(key)
+	slot[order] = numpy.arange(key.shape[0]) - numpy.searchsorted(sortedKey, sortedKey, side='left')
+	
+	good &= (slot < nMax)
+	data.reshape(nChunks, nStands, nMax, 4096)[chunk[good], aStand[good], slot[good]] = iq[good]
+	
+	return numpy.bincount(key[good], minlength=nChunks*nStands).reshape(nChunks, nStands)
+
+
 def readBlock(filehandle):
 	"""Function to read in a single DRX block (four frames) and store the 
 	contents as a ObservingBlock object.  This function wraps 
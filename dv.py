@@ -1,5 +1,11 @@
 from mpi4py import MPI
 import disper
+import dedisp
+import search
+import noise
+import candidates
+import sift
+import spectrogram
 import sys
 import numpy as np
 import glob
@@ -246,114 +252,430 @@ def massagesp(spectrometer, windows_x=43,windows_y=100):
     spectrometer -= mean
     return spectrometer
 
+def exchange_halo(comm, spectarray, nown, need):
+    """
+    Copy the spectrogram bins a rank needs past the end of its own share from the ranks that
+    own them.  Rank r owns the nown bins from r*nown on, stored in spectarray[:, :nown], and
+    spectarray[:, nown:] is filled with bins (r+1)*nown up to need[r].  Only these edges are
+    sent, once, so no rank ever has to hold or reduce the full length time series.
+    Required:
+    comm       - MPI communicator
+    spectarray - (nchan, nown + halo) channel-major spectrogram of this rank
+    nown       - number of time bins every rank owns
+    need       - end (exclusive) of the time bins every rank needs, one per rank
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    sends = []
+    for r in range(rank):#ranks before this one that need some of its bins
+        lo = max(rank*nown, (r+1)*nown)
+        hi = min((rank+1)*nown, need[r])
+        if hi > lo:
+            buf = np.ascontiguousarray(spectarray[:, lo-rank*nown:hi-rank*nown])
+            sends.append((comm.Isend(buf, dest=r, tag=rank), buf))
+    for q in range(rank+1, size):#ranks after this one that own some of the bins this one needs
+        lo = max(q*nown, (rank+1)*nown)
+        hi = min((q+1)*nown, need[rank])
+        if hi > lo:
+            buf = np.empty((spectarray.shape[0], hi-lo), dtype=spectarray.dtype)
+            comm.Recv(buf, source=q, tag=q)
+            spectarray[:, lo-rank*nown:hi-rank*nown] = buf
+    MPI.Request.Waitall([request for request, buf in sends])
+
+def join_boxcars(comm, ts, tout, widths):
+    """
+    Boxcar means of this rank's part of the time series, bins tout[rank] to tout[rank+1], on the
+    boxcar grid of the whole series, so the boxcars are the same whatever the number of
+    processors.  A rank has the boxcars that start in its part; the sum of the bins of its part
+    that belong to a boxcar started before it is sent to the rank that has that boxcar, which is
+    more than one rank back for a boxcar wider than a rank's part.
+    Required:
+    comm       - MPI communicator
+    ts         - (nDM, tout[rank+1]-tout[rank]) dedispersed time series of this rank
+    tout       - first time bin of every rank's part, and the end of the series
+    widths     - boxcar widths in time bins
+    Returns the number of the first boxcar of every width and a list with the (nDM, n) boxcar
+    means of each width.
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    owner = lambda t: np.searchsorted(tout, t, 'right')-1 #rank whose part has time bin t
+    sends = []
+    firsts = []
+    means = []
+    for ranki, (first, sums) in enumerate(search.grid_sums(ts, tout[rank], widths)):
+        width = widths[ranki]
+        if tout[rank] % width:#the first boxcar starts before this part
+            if tout[rank+1] > tout[rank]:
+                buf = np.ascontiguousarray(sums[:, 0])
+                sends.append((comm.Isend(buf, dest=owner(first*width), tag=ranki), buf))
+            first, sums = first+1, sums[:, 1:]
+        for q in range(rank+1, size):#ranks after this one with the rest of its last boxcar
+            if tout[q+1] > tout[q] and tout[q] % width and owner(tout[q]//width*width) == rank:
+                buf = np.empty(sums.shape[0])
+                comm.Recv(buf, source=q, tag=ranki)
+                sums[:, tout[q]//width-first] += buf
+        firsts.append(first)
+        means.append(sums/width)
+    MPI.Request.Waitall([request for request, buf in sends])
+    return np.array(firsts), means
+
+class PulseFile():
+      """
+      Candidate text files for one decimation level.  Pulses are appended to
+      ppc_SNR_pol_<pol>_td_<ranki>[_rank_<rank>]_no_<fileno>.txt and a new file
+      is started every 200,000 pulses.
+      """
+
+      def __init__(self, pol, ranki, rank=None):
+          self.pol    = pol
+          self.ranki  = ranki
+          self.rank   = rank
+          self.fileno = 1 # file number star from 1
+          self.npulse = 0 # pulse number
+          self.outfile = open(self.filename(), 'a')
+
+      def filename(self):
+          if self.rank is None:
+              return "ppc_SNR_pol_%.1i_td_%.2i_no_%.05i.txt" % (self.pol, self.ranki, self.fileno)
+          return "ppc_SNR_pol_%.1i_td_%.2i_rank_%.3i_no_%.05i.txt" % (self.pol, self.ranki, self.rank, self.fileno)
+
+      def write(self, sn, DM, tOffset, dtau, dnu, nu, mean, rms):
+          """
+          Record all pulses above threshold in a thresholded SNR series (see
+          Threshold).  tOffset is the time of sn[0] and dtau the time per bin.
+          """
+          ones = np.where(sn!=-1)[0]
+          self.write_pulses(sn[ones], DM, tOffset + ones*dtau, dtau, dnu, nu, mean, rms)
+
+      def write_pulses(self, sn, DM, time, dtau, dnu, nu, mean, rms):
+          """
+          Record a list of pulses, e.g. the detections of noise.detect.  sn,
+          DM, time, mean and rms are arrays with a value per pulse or single
+          values shared by all of them.
+          """
+          sn, DM, time, mean, rms = np.broadcast_arrays(sn, DM, time, mean, rms)
+          for one in range(len(sn)):# Now record all pulses above threshold
+              pulse = OutputSource()
+              self.npulse += 1
+              pulse.pulse = self.npulse
+              pulse.SNR = sn[one]
+              pulse.DM = DM[one]
+              pulse.time = time[one]
+              pulse.dtau = dtau
+              pulse.dnu = dnu
+              pulse.nu = nu
+              pulse.mean = mean[one]
+              pulse.rms = rms[one]
+              self.outfile.write(pulse.formatter.format(pulse)[:-1]) 
+              if self.npulse > 200000*self.fileno:
+                  self.outfile.close()
+                  self.fileno += 1
+                  self.outfile = open(self.filename(), 'a')
+          self.outfile.flush()
+
+      def close(self):
+          self.outfile.close()
+
+
+class PulseStore(PulseFile):
+      """
+      Same as PulseFile, but the pulses are appended to the binary candidate
+      store ppc_SNR_pol_<pol>_td_<ranki>[_rank_<rank>].cand (see candidates.py)
+      in blocks instead of being formatted one by one into text files.
+      """
+
+      def __init__(self, pol, ranki, rank=None):
+          self.pol    = pol
+          self.ranki  = ranki
+          self.rank   = rank
+          self.store  = candidates.CandidateWriter(self.storename())
+
+      def storename(self):
+          if self.rank is None:
+              return "ppc_SNR_pol_%.1i_td_%.2i.cand" % (self.pol, self.ranki)
+          return "ppc_SNR_pol_%.1i_td_%.2i_rank_%.3i.cand" % (self.pol, self.ranki, self.rank)
+
+      def write_pulses(self, sn, DM, time, dtau, dnu, nu, mean, rms):
+          self.store.append(sn, DM, time, dtau, dnu, nu, mean, rms)
+
+      def close(self):
+          self.store.close()
+
+
+class PulseBuffer(PulseFile):
+      """
+      Same as PulseFile, but the pulses are kept in memory as arrays with the
+      columns of candidates.schema, so they can be sifted before they are
+      written (see write_sifted).
+      """
+
+      def __init__(self, pol, ranki, rank=None):
+          self.pol    = pol
+          self.ranki  = ranki
+          self.rank   = rank
+          self.blocks = []
+
+      def write_pulses(self, sn, DM, time, dtau, dnu, nu, mean, rms):
+          sn, DM, time, dtau, dnu, nu, mean, rms = np.broadcast_arrays(sn, DM, time, dtau, dnu, nu, mean, rms)
+          block = np.zeros(len(sn), dtype=candidates.schema)
+          for column, values in zip(candidates.columns[1:], (sn, DM, time, dtau, dnu, nu, mean, rms)):
+              block[column] = values
+          self.blocks.append(block)
+
+      def table(self):
+          if len(self.blocks) == 0:
+              return np.zeros(0, dtype=candidates.schema)
+          return np.concatenate(self.blocks)
+
+      def close(self):
+          pass
+
+def write_sifted(pulsefiles, pol, rank, DMtrials):
+    """
+    Cluster the pulses of all the PulseBuffers of this processor over time, DM and width with
+    sift.py and write the peak of every cluster to ppc_SNR_pol_<pol>_rank_<rank>_sifted.cand.
+    """
+    cand = np.concatenate([pulsefile.table() for pulsefile in pulsefiles])
+    sifted = sift.sift(cand, DMtrials)
+    print 'rank',rank,':',len(cand),'pulses sifted into',len(sifted),'clusters'
+    sift.write_sifted("ppc_SNR_pol_%.1i_rank_%.3i_sifted.cand" % (pol, rank), sifted)
+
+
 if __name__ == '__main__':
     fcl = 360/4
     fch = 3700/4
     comm  = MPI.COMM_WORLD
     rank  = comm.Get_rank()
-    fpp   =  264/12 #spectrogram per processer you want, limited mainly by 64GB memory per node (32GB Hokieone)
+    size  = comm.Get_size()
+    fpp   =  264/12 #spectrogram per processer you want, limited mainly by 64GB memory per node (32GB Hokieone), twice as many fit with a float32 or quantized container
     nodes =  2 #the number of node requensted in sh
     pps   =  6 #processer per node requensted in sh
     numberofFiles=fpp*nodes*pps #totalnumberofspec = 6895.
 
+    stream    = False #True = dedisperse a channel-major copy of the spectrogram in time blocks, memory does not depend on fpp
+    blocksize = 2**16 #time bins per block in stream mode
+    dmbatch   = 32    #DM trials dedispersed together, the memory mode keeps dmbatch 4 hour time series
+    minbins   = 64    #fewest decimated bins a block must have to search that pulse width in stream mode
+    algorithm = 'brute' #'brute' = one DM trial at a time, 'fdmt' = all DM trials at once with the Fast DM Transform (stream mode only)
+    fdmtdelay  = 2048 #largest spread of the delays in time bins of one FDMT pass, the DM trials with larger delays go to the next passes
+    fdmtmemory = 8*2**30 #bytes one FDMT may hold, dv.py stops with a MemoryError before it starts if a block needs more
+
     maxpw = 600 #Maximum pulse width to search in seconds. default = 1 s.
     thresh= 5.0 #SNR cut off
-
-    fn   = sorted(glob.glob('05*.npy')) 
-    tInt = np.load('tInt.npy')
+    noisestat  = 'rms' #'rms' = mean and rms of the whole time series, 'mad' = median and MAD rms in blocks of noiseblock bins (robust to pulses, follows drifts)
+    noiseblock = 4096  #boxcar bins per block of the 'mad' statistics
+    candformat = 'binary' #'binary' = ppc_SNR_*.cand candidate stores (candidates.py), 'text' = ppc_SNR_*.txt files
+
+    sifting    = False #True = cluster the pulses of every processor over time, DM and width and write only the peak of each cluster (sift.py)
+
+    if sifting:
+        Pulses = PulseBuffer
+    elif candformat == 'binary':
+        Pulses = PulseStore
+    else:
+        Pulses = PulseFile
+
+    spectfile = None #spectrogram container of ft.py (spectrogram.py), None = the <data file>_ft.npy container ft.py made here, or one 05*.npy file per chunk and tInt.npy, freq1.npy, freq2.npy of freqtint.py if there is none
+
+    if spectfile is None:
+        containers = [name for name in sorted(glob.glob('*_ft.npy')) if spectrogram.isContainer(name)]
+        if len(containers) > 1:
+            raise ValueError("More than one spectrogram container here (%s), set spectfile to the one to search" % ', '.join(containers))
+        if containers:
+            spectfile = containers[0]
+
+    if spectfile is not None:
+        #every chunk is a memory mapped slab of the container, only the window of pol and fcl:fch is read,
+        #tInt and the frequencies are in its sidecar
+        spec   = spectrogram.SpectrogramFile(spectfile)
+        nfiles = spec.nSlabs
+        chunk  = spec.slab
+        tInt   = spec.tInt
+        good   = spec.valid #slabs ft.py has written, the others are zeros until interpolate.py fills them
+        if rank == 0 and not good.all():
+            print 'chunks not valid in',spectfile,', searched as zeros:',spec.offsets[~good]
+    else:
+        fn     = sorted(glob.glob('05*.npy')) 
+        nfiles = len(fn)
+        chunk  = lambda i: np.load(fn[i], mmap_mode='r')
+        tInt   = np.load('tInt.npy')
+        good   = np.ones(nfiles, dtype=bool)
 
     pol = 1  # 0 = lower tunning, 1 = higher tunning.
 
     DMstart =  0 #1.0 #initial DM trial
     DMend   =  5000 #90.0 #finial  DM trial
+    SSratio =  0.8 #S/N that a pulse keeps at the neighbouring DM trial, sets the DM spacing
     npws = int(np.round(np.log2(maxpw/tInt)))+1 # +1 Due to in range(y) it goes to y-1 only
-
-    spect=np.load(fn[0],mmap_mode='r')[:,:,fcl:fch]
-    spectarray = np.zeros((fpp,spect.shape[0],spect.shape[2])) # X and Y are merged already after bandpass
+    widths = 2**np.arange(npws) #boxcar widths searched in time bins, any list works, e.g. [1,2,3,4,6,8,12,16]
+
+    spect=chunk(0)[:,:,fcl:fch]
+
+    if spectfile is not None:
+        freq=(spec.freq1 if pol==0 else spec.freq2)[fcl:fch].copy()
+    elif pol==0:
+        freq=np.load('freq1.npy')[fcl:fch]
+    else: 
+        freq=np.load('freq2.npy')[fcl:fch]
+    freq /= 10**6
+
+    def background(i):
+        #bandpass and baseline corrected spectrogram of chunk i, all zeros for a chunk that is not
+        #valid, its zero bandpass would turn it into NaN
+        if not good[i]:
+            return np.zeros((spect.shape[0], spect.shape[2]), dtype=spect.dtype)
+        return massagesp( np.array(chunk(i)[:,pol,fcl:fch]), 10, 50 )
+    cent_freq = np.median(freq)
+    BW   = freq.max()-freq.min()
+    DMtrials = DMstart # 0
+    if rank == 0:
+        #DM spacing from the S/N loss of Cordes & McLaughlin, the trials get sparser once the
+        #dispersion smearing in a channel is wider than a time bin
+        DMtrials = disper.dm_grid(DMstart, DMend, SSratio, cent_freq/10**3, BW, len(freq), tInt)
+        print 'DM trials =',len(DMtrials)
+
+    DMtrials = comm.bcast(DMtrials,root =0)
+
+    #drop the DM trials that have the same delay in every channel as a smaller DM,
+    #rank 0 makes the plan (or reuses the one from an earlier run) and every rank loads it
+    planname = 'dmplan_pol%.1i.npz' % pol
+    if rank == 0:
+        dedisp.dm_plan(freq, DMtrials, tInt, planname)
+    comm.Barrier()
+    DMtrials, delays = dedisp.dm_plan(freq, DMtrials, tInt, planname)
+
+    if algorithm == 'fdmt':
+        stream = True
+
+    if stream:
+        #build the channel-major spectrogram once, every rank massages its share of the files; it is
+        #reused only if it was completed from the same spectrogram, pol and channels, a file left half
+        #filled by a killed run or made from other data is built again
+        cmname = 'spectrogram_pol%.1i.npy' % pol
+        if spectfile is not None:
+            source = {'source': spectfile, 'size': os.path.getsize(spectfile), 'valid': good.tolist()}
+        else:
+            source = {'source': fn, 'size': sum(os.path.getsize(name) for name in fn)}
+        source.update({'files': nfiles, 'pol': pol, 'fcl': fcl, 'fch': fch})
+        built = False
+        if rank == 0:
+            built = dedisp.channel_major_ready(cmname, source)
+            if not built:
+                dedisp.create_channel_major(cmname, spect.shape[2], nfiles*spect.shape[0])
+        built = comm.bcast(built, root=0)
+        if not built:
+            for i in range(rank, nfiles, size):
+                dedisp.fill_channel_major(cmname, background(i), i*spect.shape[0])
+        comm.Barrier()
+        if rank == 0 and not built:
+            dedisp.mark_channel_major(cmname, source)
+
+        cm = np.load(cmname, mmap_mode='r')
+        #pulse widths must fit in a block, wider boxcars are left out in stream mode
+        widths = widths[widths <= blocksize/minbins]
+
+        #every rank takes a contiguous share of the blocks and searches all DM trials and widths in it
+        nout = dedisp.valid_length(delays, cm.shape[1]).max()
+        nblocks = int(np.ceil(1.*nout/blocksize))
+        tstart = min(nout, int(np.ceil(1.*nblocks/size))*rank*blocksize)
+        tstop  = min(nout, int(np.ceil(1.*nblocks/size))*(rank+1)*blocksize)
+
+        pulsefiles = [Pulses(pol, ranki, rank) for ranki in range(len(widths))]
+        if algorithm == 'fdmt':
+            blocks = dedisp.stream_fdmt(cm, delays, freq, tstart, tstop, blocksize, dmbatch, fdmtdelay, fdmtmemory)
+        else:
+            blocks = dedisp.stream_dedisperse(cm, delays, tstart, tstop, blocksize, dmbatch)
+        for t0, kDM, ts, nvalid, down in blocks:
+            #search all the boxcar widths of the block at once; the time series of a DM trial that fdmt
+            #gives decimated by down (it smears a pulse over more bins) are searched for the widths of
+            #a multiple of down bins, with boxcars of width/down of their bins
+            search_widths = [ranki for ranki in range(len(widths)) if widths[ranki] % down == 0]
+            means = search.boxcar_means(ts, [widths[ranki]/down for ranki in search_widths])
+            nbins = search.valid_bins(nvalid, [widths[ranki]/down for ranki in search_widths])
+            nbins[nbins < minbins] = 0
+            if noisestat == 'mad':
+                for i, ranki in enumerate(search_widths):
+                    k, t, sn, mean, rms = noise.detect(means[i], nbins[:,i], thresh, noiseblock)
+                    pulsefiles[ranki].write_pulses(sn, DMtrials[kDM[k]], t0*tInt+t*tInt*widths[ranki], tInt*widths[ranki], freq[1]-freq[0], cent_freq, mean, rms)
+                continue
+            mean, rms = search.stats(means, nbins)
+            for i, ranki in enumerate(search_widths):
+                sn = search.threshold(means[i], nbins[:,i], mean[:,i], rms[:,i], thresh)
+                for k in range(len(kDM)):
+                    if nbins[k,i] > 0:
+                        pulsefiles[ranki].write(sn[k], DMtrials[kDM[k]], t0*tInt, tInt*widths[ranki], freq[1]-freq[0], cent_freq, mean[k,i], rms[k,i])
+        for pulsefile in pulsefiles:
+            pulsefile.close()
+        if sifting:
+            write_sifted(pulsefiles, pol, rank, DMtrials)
+        sys.exit()
+
+    nrow = spect.shape[0]
+    nown = fpp*nrow #time bins of spectrogram per processer
+    ntotal = numberofFiles*nrow #length of the 4 hour time series
+    tfirst = rank*nown #first time bin of this processor's spectrogram
+
+    #every processor searches the 4 hour time series of its own spectrogram, from tout[rank] to tout[rank+1]
+    tout = np.minimum(ntotal, np.arange(size+1)*nown)
+    tout[-1] = ntotal
+    #and needs the spectrogram up to the largest delay past that, the halo beyond its own bins
+    need = np.minimum(ntotal, tout[1:]+delays.max())
+    nhalo = max(0, need[rank]-tfirst-nown)
+
+    spectarray = np.zeros((spect.shape[2],nown+nhalo), dtype=spect.dtype) # X and Y are merged already after bandpass, channel-major so every channel is contiguous, float32 for a float32 or quantized container
 
     #cobimed spectrogram and remove background
     for i in range(fpp):
-        print '1',(np.load(fn[rank*fpp+i])[:,pol,fcl:fch]).shape
-        print '2',massagesp( np.load(fn[rank*fpp+i])[:,pol,fcl:fch] ).shape
-        spectarray[i,:,:] = massagesp( np.load(fn[rank*fpp+i])[:,pol,fcl:fch], 10, 50 )
+        print '1',(chunk(rank*fpp+i)[:,pol,fcl:fch]).shape
+        print '2',background(rank*fpp+i).shape
+        spectarray[:,i*nrow:(i+1)*nrow] = background(rank*fpp+i).T
 
-    np.save('spectarray%.2i' % rank, spectarray)
+    np.save('spectarray%.2i' % rank, spectarray[:,:nown])
     #sys.exit()
 
-    if  pol < 4:
-        if pol==0:
-            freq=np.load('freq1.npy')[fcl:fch]
-        else: 
-            freq=np.load('freq2.npy')[fcl:fch]
-        freq /= 10**6
-        cent_freq = np.median(freq)
-        BW   = freq.max()-freq.min()
-        DM = DMstart
-    
-        txtsize=np.zeros((npws,2),dtype=np.int32) #fileno = txtsize[ranki,0], pulse number = txtsize[ranki,1],ranki is the decimated order of 2
-        txtsize[:,0]=1 #fileno star from 1
-
+    exchange_halo(comm, spectarray, nown, need)
 
-        DMtrials = DMstart # 0
-        if rank == 0:
-            while DM < DMend:
-                #dDM = disper.dDMi(DMtrial = 1.*DM, nuCenteralMHz = 1.*cent_freq, channelMHz = freq[1]-freq[0], BMHz = freq[-1]-freq[0], SSratio = 0.8, temporal_resol = 1.*tInt)
-                #print dDM
-                if DM < 1000:
-                    dDM = 0.1
-		elif DM >= 1000:
-                    dDM = 1.
-                DM += dDM
-                DMtrials = np.append(DMtrials,DM)
-
-        DMtrials = comm.bcast(DMtrials,root =0)
-
-        for DM in DMtrials:
-            #print 'rank = ',rank, ' DM trial = ',DM
-            tb=np.round((delay2(freq,DM)/tInt)).astype(np.int32)
-
-            ts=np.zeros((tb.max()+numberofFiles*np.load(fn[0],mmap_mode='r').shape[0]))
-            for freqbin in range(len(freq)): 
-                for i in range(fpp):
-                    ts[tb.max()-tb[freqbin] + (rank*fpp+i)*spect.shape[0] :tb.max()-tb[freqbin] + (rank*fpp+i+1)*spect.shape[0] ] += spectarray[i,:,freqbin]
-
-            tstotal=ts*0#initiate a 4 hour blank time series
-            comm.Allreduce(ts,tstotal,op=MPI.SUM)#merge the 4 hour timeseries from all processor
-            tstotal = tstotal[tb.max():len(tstotal)-tb.max()]#cut the dispersed time lag
-
-
-            '''
-            # save the time series around the Pulsar's DM
-            if rank == 0:
-                if np.abs(DM - 10.922) <= dDM:
-                    print 'DM=',DM
-                    np.save('ts_pol%.1i_DMx100_%.6i' % (pol,DM*100),tstotal)
-            sys.exit()
-            '''
-
-            #"""#search for signal with decimated timeseries
-            if rank<npws:#timeseries is ready for signal search
-                ranki=rank
-                filename = "ppc_SNR_pol_%.1i_td_%.2i_no_%.05i.txt" % (pol,ranki,txtsize[ranki,0])
-                outfile = open(filename,'a')
-                ndown = 2**ranki #decimate the time series
-                sn,mean,rms = Threshold(Decimate_ts(tstotal,ndown),thresh,niter=0)
-                ones = np.where(sn!=-1)[0]
-                for one in ones:# Now record all pulses above threshold
-                    pulse = OutputSource()
-                    txtsize[ranki,1] += 1
-                    pulse.pulse = txtsize[ranki,1]
-                    pulse.SNR = sn[one]
-                    pulse.DM = DM
-                    pulse.time = one*tInt*ndown
-                    pulse.dtau = tInt*ndown
-                    pulse.dnu = freq[1]-freq[0]
-                    pulse.nu = cent_freq
-                    pulse.mean = mean
-                    pulse.rms = rms
-                    outfile.write(pulse.formatter.format(pulse)[:-1]) 
-                    if txtsize[ranki,1] >200000*txtsize[ranki,0]:
-                        outfile.close()
-                        txtsize[ranki,0]+=1
-                        filename = "ppc_SNR_pol_%.1i_td_%.2i_no_%.05d.txt" % (pol,ranki,txtsize[ranki,0])
-                        outfile = open(filename,'a')
+    if  pol < 4:
+        pulsefiles = [Pulses(pol, ranki, rank) for ranki in range(len(widths))]
+
+        nout = tout[rank+1]-tout[rank]
+        for b in range(0, len(DMtrials), dmbatch):
+            kDM = np.arange(b, min(b+dmbatch, len(DMtrials)))
+            #this processor's part of the time series of a batch of DM trials, the dispersed
+            #time lag is cut at the end of the 4 hour time series
+            ts = dedisp.dedisperse_block(spectarray, delays[kDM], tout[rank]-tfirst, nout)
+
+            #search all the boxcar widths at once on the boxcar grid of the whole 4 hour time series,
+            #the boxcars across the edge to the next processor are completed with its sums; a boxcar
+            #is valid if all of its bins are before the dispersed time lag.  With noisestat = 'rms'
+            #the mean and rms are of the whole time series, so the sums and numbers of boxcar bins
+            #are added up over the processors
+            first, means = join_boxcars(comm, ts, tout, widths)
+            nbins = np.clip(search.valid_bins(ntotal-delays[kDM].max(1), widths)-first, 0, [box.shape[1] for box in means])
+            if noisestat == 'mad':#blockwise statistics need nothing from the other processors
+                for ranki in range(len(widths)):
+                    k, t, sn, mean, rms = noise.detect(means[ranki], nbins[:,ranki], thresh, noiseblock)
+                    pulsefiles[ranki].write_pulses(sn, DMtrials[kDM[k]], (first[ranki]+t)*tInt*widths[ranki], tInt*widths[ranki], freq[1]-freq[0], cent_freq, mean, rms)
+                continue
+            total = nbins*0#bins of the whole time series
+            comm.Allreduce(nbins,total,op=MPI.SUM)
+            sums = search.moments(means, nbins)
+            mean = sums*0
+            comm.Allreduce(sums,mean,op=MPI.SUM)
+            mean /= np.maximum(total,1)
+            sqsums = search.moments(means, nbins, mean)
+            rms = sqsums*0
+            comm.Allreduce(sqsums,rms,op=MPI.SUM)
+            rms = np.sqrt(rms/np.maximum(total,1))
+
+            for ranki in range(len(widths)):
+                sn = search.threshold(means[ranki], nbins[:,ranki], mean[:,ranki], rms[:,ranki], thresh)
+                for k in range(len(kDM)):
+                    if nbins[k,ranki] > 0:
+                        pulsefiles[ranki].write(sn[k], DMtrials[kDM[k]], first[ranki]*widths[ranki]*tInt, tInt*widths[ranki], freq[1]-freq[0], cent_freq, mean[k,ranki], rms[k,ranki])
+
+        for pulsefile in pulsefiles:
+            pulsefile.close()
+        if sifting:
+            write_sifted(pulsefiles, pol, rank, DMtrials)
@@ -306,18 +306,16 @@ if __name__ == '__main__':
         txtsize=np.zeros((npws,2),dtype=np.int32) #fileno = txtsize[ranki,0], pulse number = txtsize[ranki,1],ranki is the decimated order of 2
         txtsize[:,0]=1 #fileno star from 1
 
-        tbmax=0 #repeat control, if dedispersion time series are identical, skip dedispersion calculation
+        tbprev=None #repeat control, if dedispersion time series are identical, skip dedispersion calculation
         while DM < DMend:
             #if DM >=1000.: dDM = 1.
             #else: dDM = 0.1
             dDM = disper.dDMi(DMtrial = 1.*DM, nuCenteralMHz = 1.*cent_freq, channelMHz = freq[1]-freq[0], BMHz = freq[-1]-freq[0], SSratio = 0.8, temporal_resol = 1.*tInt)
             tb=np.round((delay2(freq,DM)/tInt)).astype(np.int32)
-            if tb.max()-tbmax==0:#identical dedispersion time series checker
-                tbmax=tb.max()
-                if DM > 0.:
-                    DM+=dDM
+            if tbprev is not None and np.array_equal(tb, tbprev):#identical dedispersion time series checker, every channel has to match
+                DM+=dDM
                 continue
-            tbmax=tb.max()
+            tbprev=tb
 
             ts=np.zeros((tb.max()+numberofFiles*np.load(fn[0],mmap_mode='r').shape[0]))
             for freqbin in range(len(freq)): 
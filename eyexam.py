@@ -2,24 +2,23 @@
 Use this code to examine if there are missing files.
 '''
 import numpy
-import glob
+import manifest
 
 windownumber = 2
 nodes = 2
 pps = 6
 nChunks = 1000
 nFramesAvg = 4*windownumber
+manifestfile = '057139_000656029_ft.manifest' #run manifest of the stage to examine, 057139_000656029_waterfall.manifest for waterfall.py
 
 #fn = sorted(glob.glob('waterfall05*.npy'))
 #j = numpy.zeros((len(fn)))
 #for i in range(len(fn)):
 #        j[i] = fn[i][39:48]
 
-fn = sorted(glob.glob('05*.npy'))
-j = numpy.zeros((len(fn)))
-for i in range(len(fn)):
-        j[i] = fn[i][30:39]
-
-x = numpy.arange(j[-1]/nChunks/nFramesAvg)*nChunks*nFramesAvg
-offset = numpy.setdiff1d(x, j)
+runManifest = manifest.Manifest(manifestfile)
+records = runManifest.read()
+offset = runManifest.missing(nChunks*nFramesAvg, records=records)
+failed = runManifest.failed(records)
 print 'missing ', offset.shape, 'files'
+print 'of which', failed.shape, 'failed:', failed
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""Module that provides interchangeable FFT backends for the spectrometer
+stages.  The backends are tried in the order pyFFTW, scipy (scipy.fft, or
+scipy.fftpack before scipy 1.4) and numpy.fft and the first one that can be imported is used unless a name is given.  Run
+as a script to benchmark the available backends:
+
+    python fftbackend.py [-n nBlock] [-w workers] [LFFT ...]"""
+
+import os
+import sys
+import time
+import getopt
+import numpy
+
+try:
+	import scipy.fft as scipy_fft
+except ImportError:
+	scipy_fft = None
+
+try:
+	import scipy.fftpack as scipy_fftpack
+except ImportError:
+	scipy_fftpack = None
+
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+try:
+	import pyfftw
+	import pyfftw.builders
+except ImportError:
+	pyfftw = None
+
+__version__ = '0.1'
+__revision__ = '$ Revision: 1 $'
+__all__ = ['NumpyBackend', 'ScipyBackend', 'FFTWBackend', 'getBackend', 'listBackends', 'benchmark', 'backendOrder', '__version__', '__revision__', '__all__']
+
+# Order in which getBackend looks for an available backend
+backendOrder = ['fftw', 'scipy', 'numpy']
+
+# Default location of the saved FFTW wisdom
+wisdomFile = os.path.join(os.path.expanduser('~'), '.fftw_wisdom.pkl')
+
+
+class NumpyBackend(object):
+	"""Backend that uses numpy.fft.  Always available, single threaded and
+	computes in double precision."""
+
+	name = 'numpy'
+
+	def __init__(self, workers=1):
+		self.workers = 1
+
+	def fft(self, data, axis=-1):
+		"""Return the 1-D FFT of 'data' along 'axis'."""
+
+		return numpy.fft.fft(data, axis=axis)
+
+
+class ScipyBackend(object):
+	"""Backend that uses scipy.fft (scipy 1.4 and later), or scipy.fftpack
+	for older versions such as the last ones for Python 2.  Both keep single
+	precision input in single precision; only scipy.fft spreads batched
+	transforms over 'workers' threads, scipy.fftpack is single threaded."""
+
+	name = 'scipy'
+
+	def __init__(self, workers=1):
+		if scipy_fft is None and scipy_fftpack is None:
+			raise ImportError("neither scipy.fft nor scipy.fftpack is available")
+		self.workers = workers if scipy_fft is not None else 1
+
+	def fft(self, data, axis=-1):
+		"""Return the 1-D FFT of 'data' along 'axis'."""
+
+		if scipy_fft is not None:
+			return scipy_fft.fft(data, axis=axis, workers=self.workers)
+		return scipy_fftpack.fft(data, axis=axis)
+
+
+class FFTWBackend(object):
+	"""Backend that uses pyFFTW.  One plan is built and cached per input
+	shape, dtype and axis, and the accumulated wisdom is saved to
+	'wisdomFile' so that later runs (and the other ranks) skip the planning."""
+
+	name = 'fftw'
+
+	def __init__(self, workers=1, wisdomFile=wisdomFile, plannerEffort='FFTW_MEASURE'):
+		if pyfftw is None:
+			raise ImportError("pyfftw is not available")
+		self.workers = workers
+		self.wisdomFile = wisdomFile
+		self.plannerEffort = plannerEffort
+		self.plans = {}
+
+		if self.wisdomFile is not None and os.path.exists(self.wisdomFile):
+			try:
+				fh = open(self.wisdomFile, 'rb')
+				pyfftw.import_wisdom(pickle.load(fh))
+				fh.close()
+			except (IOError, EOFError, pickle.UnpicklingError):
+				pass
+
+	def __saveWisdom(self):
+		"""Private function to write the current wisdom out to 'wisdomFile'.
+		The file is written under a temporary name first so that concurrent
+		ranks never see a partial file."""
+
+		if self.wisdomFile is None:
+			return
+		tempname = "%s.%i" % (self.wisdomFile, os.getpid())
+		try:
+			fh = open(tempname, 'wb')
+			pickle.dump(pyfftw.export_wisdom(), fh)
+			fh.close()
+			os.rename(tempname, self.wisdomFile)
+		except (IOError, OSError):
+			pass
+
+	def fft(self, data, axis=-1):
+		"""Return the 1-D FFT of 'data' along 'axis'."""
+
+		key = (data.shape, data.dtype.str, axis)
+		try:
+			plan = self.plans[key]
+		except KeyError:
+			plan = pyfftw.builders.fft(numpy.empty_like(data), axis=axis, threads=self.workers, planner_effort=self.plannerEffort)
+			self.plans[key] = plan
+			self.__saveWisdom()
+
+		# The plan owns its output array, so hand back a copy
+		return plan(data).copy()
+
+
+_backends = {'numpy': NumpyBackend, 'scipy': ScipyBackend, 'fftw': FFTWBackend}
+
+
+def listBackends():
+	"""Return the names of the backends that can be used on this machine, in
+	order of preference."""
+
+	available = []
+	for name in backendOrder:
+		try:
+			_backends[name]()
+		except ImportError:
+			continue
+		available.append(name)
+
+	return available
+
+
+def getBackend(name=None, workers=1):
+	"""Function to return an FFT backend object.  If 'name' is None the first
+	available backend in 'backendOrder' is returned, otherwise the named
+	backend ('numpy', 'scipy' or 'fftw') is returned and an ImportError is
+	raised if it cannot be used."""
+
+	if name is not None:
+		return _backends[name](workers=workers)
+
+	for name in backendOrder:
+		try:
+			return _backends[name](workers=workers)
+		except ImportError:
+			continue
+	return NumpyBackend()
+
+
+def benchmark(backend, LFFT, nBlock=64, nRepeat=5):
+	"""Time the batched (nBlock, 4, LFFT) complex64 transform used by the
+	spectrometer with the given backend.  Returns the number of LFFT-point
+	spectra computed per second."""
+
+	data = numpy.random.randn(nBlock, 4, LFFT).astype(numpy.float32) + 1j*numpy.random.randn(nBlock, 4, LFFT).astype(numpy.float32)
+	data = data.astype(numpy.complex64)
+
+	# First call builds any plans so it is not counted
+	backend.fft(data, axis=-1)
+
+	t0 = time.time()
+	for i in xrange(nRepeat):
+		backend.fft(data, axis=-1)
+	t1 = time.time()
+
+	return nRepeat*nBlock*4 / (t1 - t0)
+
+
+def main(args):
+	opts, args = getopt.getopt(args, 'n:w:')
+	nBlock = 64
+	workers = 1
+	for opt, value in opts:
+		if opt == '-n':
+			nBlock = int(value)
+		elif opt == '-w':
+			workers = int(value)
+	if len(args) > 0:
+		sizes = [int(a) for a in args]
+	else:
+		sizes = [4096, 8192, 16384]
+
+	print "%-8s %8s %14s" % ('backend', 'LFFT', 'spectra/s')
+	for name in listBackends():
+		backend = getBackend(name, workers=workers)
+		for LFFT in sizes:
+			print "%-8s %8i %14.1f" % (name, LFFT, benchmark(backend, LFFT, nBlock=nBlock))
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
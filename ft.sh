@@ -27,6 +27,11 @@ module load mkl python openmpi
 
 cd /work/hokieone/ilikeit/057139_000656029
 cp /home/ilikeit/hokieone/ft.py .
+cp /home/ilikeit/hokieone/spectrometer.py .
+cp /home/ilikeit/hokieone/spectrogram.py .
+cp /home/ilikeit/hokieone/fftbackend.py .
+cp /home/ilikeit/hokieone/manifest.py .
+cp /home/ilikeit/hokieone/workqueue.py .
 cp /home/ilikeit/hokieone/errors.py .
 cp /home/ilikeit/hokieone/drx.py .
 cp /home/ilikeit/hokieone/dp.py .
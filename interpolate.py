@@ -1,20 +1,37 @@
 import numpy
-import glob
+import manifest
+import spectrogram
 
-fn = sorted(glob.glob('05*.npy'))
-j = numpy.zeros((len(fn)))
-for i in range(len(fn)):
-        j[i] = fn[i][30:39]
+manifestfile = '057139_000656029_ft.manifest' #run manifest of the stage to fill in, see manifest.py
+dryrun = True #only print the files that would be interpolated
 
-nChunks_nFramesAvg = j[1]-j[0]
-#x = total perfect offset
-x = numpy.arange(j[-1]/nChunks_nFramesAvg)*nChunks_nFramesAvg
-# k = the different between perfect and real
-k = numpy.setdiff1d(x, j)
+runManifest = manifest.Manifest(manifestfile)
+records = runManifest.read()
+offsets = numpy.array(sorted(records.keys()))
+nChunks_nFramesAvg = numpy.diff(offsets).min()
+# k = the offsets missing from the grid of the manifest
+k = runManifest.missing(nChunks_nFramesAvg, records=records)
 
 for i in range(len(k)):
-    a=fn[numpy.where( j == k[i]-nChunks_nFramesAvg)[0]]
-    b=fn[numpy.where( j == k[i]+nChunks_nFramesAvg)[0]]
-    newfn = fn[0][0:30]+'%.9i' % int(k[i]) +fn[0][39:]
+    a=records.get(k[i]-nChunks_nFramesAvg)
+    b=records.get(k[i]+nChunks_nFramesAvg)
+    if a is None or b is None or a['status'] != manifest.statusOK or b['status'] != manifest.statusOK:
+        print 'no neighbours to interpolate offset', k[i], 'from'
+        continue
+    if spectrogram.isContainer(a['name']):
+        # the chunks are slabs of a spectrogram container, fill in the slab of the missing one
+        spec = spectrogram.SpectrogramFile(a['name'], mode='r+')
+        newfn = a['name']
+        print newfn, 'offset', k[i]
+        if not dryrun:
+            newdata = spec.slab(spec.slabIndex(a['offset']))*.5+spec.slab(spec.slabIndex(b['offset']))*.5
+            spec.save(k[i], newdata)
+            runManifest.record(k[i], a['frames'], manifest.statusInterpolated, manifest.checksum(newdata), 0.0, newfn)
+            spec.setValid(runManifest.completed(name=newfn))
+        continue
+    newfn = a['name'].replace('_offset_%.9i_' % a['offset'], '_offset_%.9i_' % k[i])
     print newfn
-    #numpy.save(newfn,numpy.load(a)*.5+numpy.load(b)*.5)
+    if not dryrun:
+        newdata = numpy.load(a['name'])*.5+numpy.load(b['name'])*.5
+        numpy.save(newfn,newdata)
+        runManifest.record(k[i], a['frames'], manifest.statusInterpolated, manifest.checksum(newdata), 0.0, newfn)
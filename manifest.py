@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""Module that keeps the run manifest of an FFT stage.  Every chunk a stage
+(ft.py, waterfall.py, chkspectrogram.py, ...) writes adds one line to an
+append-only text file:
+
+    offset frames status checksum seconds filename
+
+so the gap checkers can find the missing or failed chunks from the manifest
+alone, without listing the directory or parsing file names.  A chunk can be
+recorded more than once (e.g. when the gap re-run redoes it) and the last
+line for an offset wins.  Run as a script to build the manifest of chunks
+written before the stages kept one:
+
+    python manifest.py 057139_000656029_ft.manifest 057139_000656029_*_fft_offset_*.npy"""
+
+import os
+import re
+import sys
+import zlib
+import numpy
+
+__version__ = '0.1'
+__revision__ = '$ Revision: 1 $'
+__all__ = ['Manifest', 'manifestName', 'checksum', 'atomicSave', 'statusOK', 'statusInterpolated', '__version__', '__revision__', '__all__']
+
+# Status of a chunk that was computed and saved without problems
+statusOK = 'ok'
+# Status of a chunk that was filled in from its neighbours by interpolate.py
+statusInterpolated = 'interpolated'
+# Chunks with these statuses are not missing
+_present = (statusOK, statusInterpolated)
+
+
+def manifestName(filename, stage):
+	"""Return the name of the manifest of 'stage' (e.g. 'ft', 'waterfall')
+	run on the DRX file 'filename'."""
+
+	return "%s_%s.manifest" % (filename, stage)
+
+
+def checksum(data):
+	"""Return the CRC-32 of the values of the array 'data'."""
+
+	return zlib.crc32(numpy.ascontiguousarray(data).view(numpy.uint8)) & 0xffffffff
+
+
+def atomicSave(filename, data):
+	"""Save the array 'data' to the .npy file 'filename' (.npy is added if it
+	is not there) by writing a temporary file next to it and renaming it, so
+	a run that is killed never leaves a partly written chunk under the final
+	name.  Returns the name of the file."""
+
+	if not filename.endswith('.npy'):
+		filename += '.npy'
+	tmpname = "%s.tmp%i" % (filename, os.getpid())
+	fh = open(tmpname, 'wb')
+	try:
+		numpy.save(fh, data)
+		fh.flush()
+		os.fsync(fh.fileno())
+	finally:
+		fh.close()
+	os.rename(tmpname, filename)
+
+	return filename
+
+
+class Manifest(object):
+	"""Class for the run manifest 'filename' of a stage.  Records are
+	appended with a single write to a file opened in append mode, so the MPI
+	ranks of a stage can share one manifest."""
+
+	def __init__(self, filename):
+		self.filename = filename
+
+	def record(self, offset, frames, status, checksum, seconds, name):
+		"""Append the record of one chunk: its first frame 'offset', its
+		number of 'frames' (0 if not known), 'status' (statusOK or a short word such as 'eof'
+		or 'failed'), the 'checksum' of the data saved, the 'seconds' it
+		took and the 'name' of the file it was saved to."""
+
+		line = "%i %i %s %.8x %.3f %s\n" % (offset, frames, status, checksum, seconds, name)
+		fh = os.open(self.filename, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+		try:
+			os.write(fh, line)
+		finally:
+			os.close(fh)
+
+	def read(self):
+		"""Return a dictionary mapping every offset recorded to its last
+		record, a dictionary with the keys offset, frames, status, checksum,
+		seconds and name.  Lines that were cut short are skipped."""
+
+		records = {}
+		if not os.path.exists(self.filename):
+			return records
+
+		fh = open(self.filename)
+		for line in fh:
+			fields = line.split()
+			if len(fields) != 6 or not line.endswith('\n'):
+				continue
+			records[int(fields[0])] = {'offset': int(fields[0]), 'frames': int(fields[1]), 'status': fields[2],
+							'checksum': int(fields[3], 16), 'seconds': float(fields[4]), 'name': fields[5]}
+		fh.close()
+
+		return records
+
+	def missing(self, step, end=None, records=None):
+		"""Return the sorted array of the chunk offsets 0, step, 2*step, ...
+		below 'end' that have no record or whose last record is neither
+		statusOK nor statusInterpolated.  If 'end' is not given the grid stops
+		at the last offset recorded."""
+
+		if records is None:
+			records = self.read()
+		if end is None:
+			end = max(records.keys())+1 if len(records) > 0 else 0
+
+		return numpy.array([offset for offset in xrange(0, int(end), int(step))
+						if offset not in records or records[offset]['status'] not in _present], dtype=numpy.int64)
+
+	def completed(self, records=None, checkFiles=True, name=None):
+		"""Return the set of the offsets whose last record is statusOK or
+		statusInterpolated and, if 'checkFiles' is True, whose file is still
+		there.  These are the chunks a stage that is run again can skip.  If
+		'name' is given only the chunks saved to that file (e.g. a spectrogram
+		container, see spectrogram.py) count."""
+
+		if records is None:
+			records = self.read()
+
+		return set(offset for offset, record in records.iteritems()
+				if record['status'] in _present and (name is None or record['name'] == name)
+				and (not checkFiles or os.path.exists(record['name'])))
+
+	def failed(self, records=None):
+		"""Return the sorted array of the offsets whose last record is neither
+		statusOK nor statusInterpolated, e.g. chunks that hit the end of the
+		file or raised an error."""
+
+		if records is None:
+			records = self.read()
+
+		return numpy.array(sorted(offset for offset, record in records.iteritems() if record['status'] not in _present), dtype=numpy.int64)
+
+
+def main(args):
+	if len(args) < 2:
+		print 'usage: python manifest.py manifest chunk.npy [chunk.npy ...]'
+		sys.exit(1)
+
+	manifest = Manifest(args[0])
+	for filename in args[1:]:
+		match = re.search('_offset_(\d+)_frames', filename)
+		if match is None:
+			print 'skipping', filename
+			continue
+		data = numpy.load(filename, mmap_mode='r')
+		manifest.record(int(match.group(1)), 0, statusOK, checksum(data), 0.0, filename)
+	print len(manifest.read()), 'chunks in', args[0]
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,143 @@
+#from mpi4py import MPI
+import mpi4py
+import mpi4py.MPI as MPI
+import os
+import sys
+import numpy
+import getopt
+import drx
+import errors
+import spectrometer
+import fftbackend
+import time
+import manifest
+import workqueue
+import spectrogram
+
+def main(args):
+	"""
+	Make the products of ft.py and waterfall.py, and the bandpass statistics,
+	in one pass over the raw data.  Every chunk of nChunks fine spectra is read
+	once and gives:
+	  ft        - the fine spectrogram of the tuning windows, as saved by ft.py
+	  waterfall - the mean full band spectrum at coarseLFFT, as saved by
+	              waterfall.py (waterfall<name>.npy)
+	  bandpass  - mean, rms and maximum of the full band spectra at coarseLFFT
+	              over the chunk, a (3, 2, coarseLFFT-1) array (bandpass<name>.npy)
+	With container = True each product goes to its slab of <data file>_<product>.npy
+	instead, see spectrogram.py.
+	"""
+	windownumber = 4 # The length of FFT = windownumber * 4096
+
+	#Low tuning frequency range
+	Lfcl = 1700 * windownumber
+	Lfch = 2100 * windownumber
+	#High tuning frequency range
+	Hfcl =  670 * windownumber
+	Hfch = 1070 * windownumber
+
+        comm  = MPI.COMM_WORLD
+        rank  = comm.Get_rank()
+	t0 = time.time()
+	nChunks = 3000 #the temporal shape of a file.
+	LFFT = 4096 * windownumber #Length of the FFT. 4096 is the size of a frame readed. The mini quantized window lenght is 4096
+	coarseLFFT = 4096 #Length of the FFT of the full band products, it has to divide LFFT
+	nFramesAvg = 1*4* windownumber # the intergration time under LFFT, 4 = beampols = 2X + 2Y (high and low tunes)
+	nBlock = 50 # number of chunks transformed together by the spectrometer engine
+	fftBackend = None # 'numpy', 'scipy', 'fftw' or None to use the fastest one available
+	fftWorkers = 1 # FFT threads per rank
+	firstChunk = 0 # number of the first chunk of the file to transform
+	prefetch = 2 # chunks queued ahead on every worker rank, see workqueue.py
+	products = ['ft', 'waterfall', 'bandpass'] # products to make, any of 'ft', 'waterfall', 'bandpass'
+	container = True # True = write every product into one <data file>_<product>.npy with a .json sidecar (spectrogram.py), False = one .npy per chunk
+	precision = 'float32' # storage of the container: 'float64', 'float32', or 'uint16'/'uint8' quantized with an offset and scale per chunk and channel (spectrogram.py)
+
+	# Map the DRX file once.  The header probing is done a single time and
+	# all of the ranks share the page cache for the read-only mapping.
+	try:
+		idf = drx.DRXFile(getopt.getopt(args,':')[1][0])
+	except (IOError, OSError):
+		print getopt.getopt(args,':')[1][0],' not found'
+		sys.exit(1)
+	nFramesFile = idf.nFrames
+	srate = idf.sampleRate
+	if srate is None:
+		print 'zero division error'
+		sys.exit(1)
+	beam = idf.beam
+	beampols = idf.beampols
+	centralFreq1 = idf.centralFreq1
+	centralFreq2 = idf.centralFreq2
+	if nChunks == 0:
+		nChunks = 1
+	nFrames = nFramesAvg*nChunks
+	nCoarse = nChunks*LFFT/coarseLFFT # full band spectra per chunk
+
+	backend = fftbackend.getBackend(fftBackend, workers=fftWorkers)
+	fine = spectrometer.Spectrometer(LFFT, [(Lfcl, Lfch), (Hfcl, Hfch)], nBlock=1, framesPerChunk=nFramesAvg, backend=backend)
+	coarse = spectrometer.Spectrometer(coarseLFFT, [(0, coarseLFFT-1), (0, coarseLFFT-1)], nBlock=1, backend=backend)
+	engine = spectrometer.MultiSpectrometer(LFFT, [fine, coarse], nBlock=nBlock, framesPerChunk=nFramesAvg)
+
+	# Every chunk saved is recorded in the run manifest of its product, see manifest.py
+	runManifests = dict([(product, manifest.Manifest(manifest.manifestName(getopt.getopt(args,':')[1][0], product))) for product in products])
+	containerNames = dict([(product, spectrogram.containerName(getopt.getopt(args,':')[1][0], product) if container else None) for product in products])
+	# Rank 0 lists the chunks of the file that are missing one of the products
+	# (a rerun after a crash skips those it has) and hands them out to the
+	# other ranks as they finish their last one, see workqueue.py
+	todo = None
+	if rank == 0:
+		done = set.intersection(*[runManifests[product].completed(name=containerNames[product]) for product in products])
+		todo = [offset for offset in workqueue.chunkOffsets(nFramesFile, nFrames, firstChunk) if offset not in done]
+	if container:
+		# A slab of nChunks fine spectra, or of one coarse mean spectrum or its
+		# three statistics, per chunk, with the frequencies of the channels kept
+		fineFreq = [spectrometer.channelFrequency(LFFT, srate, *window) for window in fine.windows]
+		coarseFreq = spectrometer.channelFrequency(coarseLFFT, srate)
+		layouts = {'ft': (nChunks, fine.nChan, 1.0*LFFT/srate, fineFreq[0]+centralFreq1, fineFreq[1]+centralFreq2),
+			'waterfall': (1, coarse.nChan, 1.0*LFFT/srate*nChunks, coarseFreq+centralFreq1, coarseFreq+centralFreq2),
+			'bandpass': (3, coarse.nChan, 1.0*LFFT/srate*nChunks, coarseFreq+centralFreq1, coarseFreq+centralFreq2)}
+		specs = {}
+		for product in products:
+			rows, nChan, tInt, freq1, freq2 = layouts[product]
+			specs[product] = spectrogram.openStage(comm, containerNames[product], workqueue.chunkOffsets(nFramesFile, nFrames, firstChunk), rows, nChan,
+				tInt=tInt, freq1=freq1, freq2=freq2, precision=precision)
+
+	def transform(offset):
+		masterSpectra = numpy.zeros((nChunks, 2, Lfch-Lfcl))
+		coarseSum = numpy.zeros((2, coarseLFFT-1))
+		coarseSum2 = numpy.zeros((2, coarseLFFT-1))
+		coarseMax = numpy.zeros((2, coarseLFFT-1))
+		# Compute the spectra of both transform lengths, in the unit of intensity,
+		# in blocks of nBlock chunks; the full band spectra are only summed up
+		tChunk = time.time()
+		status = manifest.statusOK
+		try:
+			for i, n, (fineSpectra, coarseSpectra) in engine.blocks(idf, offset, nChunks):
+				masterSpectra[i:i+n] = fineSpectra
+				coarseSum += coarseSpectra.sum(0)
+				coarseSum2 += (coarseSpectra**2).sum(0)
+				numpy.maximum(coarseMax, coarseSpectra.max(0), out=coarseMax)
+		except errors.eofError:
+			print "EOF Error"
+			status = 'eof'
+		seconds = time.time()-tChunk
+                outname = "%s_%i_fft_offset_%.9i_frames" % (getopt.getopt(args,':')[1][0], beam,offset)
+		coarseMean = coarseSum/nCoarse
+		saved = {'ft': masterSpectra,
+			'waterfall': coarseMean,
+			'bandpass': numpy.array([coarseMean, numpy.sqrt(numpy.maximum(coarseSum2/nCoarse-coarseMean**2, 0)), coarseMax])}
+		for product in products:
+			prefix = '' if product == 'ft' else product
+			if container:
+				savedName = specs[product].save(offset, saved[product])
+			else:
+				savedName = manifest.atomicSave(prefix + outname, saved[product])
+			runManifests[product].record(offset, nFrames, status, manifest.checksum(saved[product]), seconds, savedName)
+	workqueue.distribute(comm, todo, transform, prefetch=prefetch)
+	# Rank 0 is the last one to finish, every chunk of the run is recorded by now
+	if container and rank == 0:
+		for product in products:
+			specs[product].setValid(runManifests[product].completed(name=containerNames[product]))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,112 @@
+"""
+Robust noise statistics of dedispersed time series used by dv.py.
+
+The baseline and rms of a series are estimated in blocks of time bins with
+the median and the median absolute deviation (MAD), so bright pulses do not
+raise the rms and slow drifts of the baseline are followed from block to
+block.  Everything works on a (DM trials, time bins) batch at once.
+"""
+
+import numpy as np
+
+# rms of a normal distribution per unit MAD
+MADSCALE = 1.4826
+
+
+def _block_median(xb, count):
+    """
+    Median of the count[...] valid values of every block of xb, where the
+    bins that are not valid have been set to +inf.  Full blocks are done
+    with a partial sort (linear time), only the few partly filled blocks at
+    the ends of the rows are sorted.
+    """
+    blocklen = xb.shape[-1]
+    median = np.empty(count.shape)
+    full = count == blocklen
+    if full.any():
+        mid = np.partition(xb[full], [(blocklen-1)//2, blocklen//2], axis=-1)
+        median[full] = 0.5*(mid[:, (blocklen-1)//2]+mid[:, blocklen//2])
+    part = ~full
+    if part.any():
+        srt = np.sort(xb[part], axis=-1)
+        n = count[part]
+        lo = np.take_along_axis(srt, (np.maximum(n-1, 0)//2)[:, None], -1)[:, 0]
+        hi = np.take_along_axis(srt, (n//2)[:, None], -1)[:, 0]
+        median[part] = np.where(n % 2 == 1, hi, 0.5*(lo+hi))
+    return median
+
+
+def block_stats(x, nbins, blocklen=4096, minfill=0.25):
+    """
+    Median baseline and MAD rms of every row of x in blocks of blocklen
+    bins.  A block with fewer than minfill*blocklen valid bins (the end of a
+    row) takes the statistics of the block before it.  The median and the
+    MAD each take one partial sort of the block.
+    Required:
+    x        - (nDM, n) batch of time series, e.g. boxcar means of one width
+    nbins    - (nDM,) number of valid bins at the start of every row
+    Options:
+    blocklen - bins per block.  default = 4096.
+    minfill  - smallest filled fraction of a block to use its own statistics.
+               default = 0.25.
+    Returns (baseline, rms), both (nDM, nblocks) arrays.
+    """
+    x = np.atleast_2d(x)
+    nDM, n = x.shape
+    nblocks = max(1, -(-n//blocklen))
+    xb = np.full((nDM, nblocks*blocklen), np.inf)
+    xb[:, :n] = x
+    xb[np.arange(nblocks*blocklen)[None, :] >= np.asarray(nbins)[:, None]] = np.inf
+    xb = xb.reshape(nDM, nblocks, blocklen)
+    count = np.clip(np.asarray(nbins)[:, None]-np.arange(nblocks)[None, :]*blocklen, 0, blocklen)
+
+    baseline = _block_median(xb, count)
+    with np.errstate(invalid='ignore'):
+        dev = np.abs(xb-baseline[..., None])
+    dev[np.isnan(dev)] = np.inf
+    rms = MADSCALE*_block_median(dev, count)
+
+    # short blocks borrow from the last block that is filled enough
+    good = count >= minfill*blocklen
+    good[:, 0] = True
+    last = np.maximum.accumulate(np.where(good, np.arange(nblocks)[None, :], 0), axis=1)
+    rows = np.arange(nDM)[:, None]
+    return baseline[rows, last], rms[rows, last]
+
+
+def snr(x, nbins, blocklen=4096, minfill=0.25):
+    """
+    S/N of every bin of x against the blockwise median baseline and MAD rms
+    of block_stats.  Bins past the valid ones are -inf.
+    Returns (sn, baseline, rms) with sn the same shape as x and baseline and
+    rms from block_stats.
+    """
+    x = np.atleast_2d(x)
+    nDM, n = x.shape
+    baseline, rms = block_stats(x, nbins, blocklen, minfill)
+    nblocks = baseline.shape[1]
+    sn = np.full((nDM, nblocks*blocklen), -np.inf)
+    sn[:, :n] = x
+    sn = sn.reshape(nDM, nblocks, blocklen)
+    sn -= baseline[..., None]
+    sn /= np.where(rms > 0, rms, np.inf)[..., None]
+    sn = sn.reshape(nDM, nblocks*blocklen)[:, :n]
+    sn[np.arange(n)[None, :] >= np.asarray(nbins)[:, None]] = -np.inf
+    return sn, baseline, rms
+
+
+def detect(x, nbins, thresh, blocklen=4096, minfill=0.25):
+    """
+    Bins of a batch of time series with a robust S/N of at least thresh.
+    Required:
+    x        - (nDM, n) batch of time series
+    nbins    - (nDM,) number of valid bins at the start of every row
+    thresh   - S/N threshold
+    Options:
+    blocklen, minfill - see block_stats
+    Returns (k, t, sn, baseline, rms): the row and bin of every detection,
+    its S/N and the baseline and rms it was measured against.
+    """
+    sn, baseline, rms = snr(x, nbins, blocklen, minfill)
+    k, t = np.nonzero(sn >= thresh)
+    return k, t, sn[k, t], baseline[k, t//blocklen], rms[k, t//blocklen]
@@ -0,0 +1,140 @@
+"""
+Single pulse search of dedispersed time series used by dv.py.
+
+A block of dedispersed time series, shape (DM trials, time bins), is
+smoothed with boxcars of several widths at once.  A boxcar of width w is
+the mean of w neighbouring bins taken every w bins, the same series that
+Decimate_ts in dv.py makes, and its bins are then thresholded in S/N.
+"""
+
+import numpy as np
+
+
+def boxcar_means(ts, widths):
+    """
+    Boxcar means of every row of ts for each width.  A width that is twice a
+    width already done is made from that one by averaging pairs of its bins
+    (so the powers of two cascade from each other), any other width is taken
+    from the running sum of the full resolution series.  Every width costs
+    O(nDM x nt).
+    Required:
+    ts     - (nDM, nt) block of dedispersed time series
+    widths - boxcar widths in time bins, e.g. [1, 2, 4, 8] or [1, 2, 3, 5, 8]
+    Returns a list with a (nDM, nt//width) array for each width.
+    """
+    ts = np.atleast_2d(ts)
+    nt = ts.shape[1]
+    done = {}
+    csum = None
+    means = []
+    for width in widths:
+        width = int(width)
+        n = nt//width
+        if width == 1:
+            box = ts
+        elif width % 2 == 0 and width//2 in done:
+            half = done[width//2]
+            box = (half[:, 0:2*n:2]+half[:, 1:2*n:2])/2.
+        else:
+            if csum is None:
+                csum = np.zeros((ts.shape[0], nt+1))
+                np.cumsum(ts, axis=1, out=csum[:, 1:])
+            edges = csum[:, 0:n*width+1:width]
+            box = (edges[:, 1:]-edges[:, :-1])/width
+        done[width] = box
+        means.append(box)
+
+    return means
+
+
+def grid_sums(ts, tstart, widths):
+    """
+    Boxcar sums of every row of ts, a block of time series that starts at
+    bin tstart of a longer one, on the boxcar grid of the longer series:
+    boxcar j of a width w is the sum of its bins j*w through (j+1)*w-1.  The
+    boxcars the block only has a part of, at its start and end, get the sum
+    of that part, so blocks that split the series anywhere can add up their
+    pieces of a boxcar.
+    Required:
+    ts     - (nDM, nt) block of dedispersed time series
+    tstart - bin of the longer series the block starts at
+    widths - boxcar widths in time bins
+    Returns a list with (first, sums) for each width, sums the (nDM, n)
+    array of the boxcars first through first+n-1 that the block overlaps.
+    """
+    ts = np.atleast_2d(ts)
+    nt = ts.shape[1]
+    csum = np.zeros((ts.shape[0], nt+1))
+    np.cumsum(ts, axis=1, out=csum[:, 1:])
+    sums = []
+    for width in widths:
+        width = int(width)
+        first = tstart//width
+        last = max(first, -(-(tstart+nt)//width))
+        edges = np.clip(np.arange(first, last+1)*width-tstart, 0, nt)
+        sums.append((first, csum[:, edges[1:]]-csum[:, edges[:-1]]))
+
+    return sums
+
+
+def valid_bins(nvalid, widths):
+    """
+    Number of boxcar bins of each row that lie entirely inside the first
+    nvalid[k] bins of row k.
+    Returns a (nDM, len(widths)) int array.
+    """
+    return np.asarray(nvalid)[:, None]//np.asarray(widths, dtype=int)[None, :]
+
+
+def moments(means, nbins, center=None):
+    """
+    Sum of the valid boxcar bins of every row and width, or the sum of their
+    squared deviations from center.  These are the pieces of the mean and
+    rms that can be added up over blocks or MPI processes.
+    Required:
+    means  - list of boxcar means from boxcar_means
+    nbins  - (nDM, nwidths) valid bins from valid_bins
+    Options:
+    center - (nDM, nwidths) mean to take the squared deviations from.
+             default = None, the plain sums.
+    Returns a (nDM, nwidths) array.
+    """
+    out = np.zeros(nbins.shape)
+    for i, box in enumerate(means):
+        valid = np.arange(box.shape[1])[None, :] < nbins[:, i:i+1]
+        if center is None:
+            out[:, i] = np.where(valid, box, 0).sum(1)
+        else:
+            out[:, i] = (np.where(valid, box-center[:, i:i+1], 0)**2).sum(1)
+    return out
+
+
+def stats(means, nbins):
+    """
+    Mean and rms of the valid boxcar bins of every row and width of a single
+    block, like Threshold(niter=0) in dv.py.
+    Returns (mean, rms), both (nDM, nwidths) arrays.
+    """
+    count = np.maximum(nbins, 1)
+    mean = moments(means, nbins)/count
+    rms = np.sqrt(moments(means, nbins, mean)/count)
+    return mean, rms
+
+
+def threshold(box, nbins, mean, rms, thresh):
+    """
+    S/N of the boxcar bins of one width for every row, with the values below
+    thresh, and the bins past the valid ones, set to -1 as in Threshold of
+    dv.py.
+    Required:
+    box    - (nDM, n) boxcar means of one width
+    nbins  - (nDM,) valid bins of every row
+    mean   - (nDM,) mean of every row
+    rms    - (nDM,) rms of every row
+    thresh - S/N threshold
+    Returns a (nDM, n) array.
+    """
+    sn = (box-mean[:, None])/np.where(rms > 0, rms, np.inf)[:, None]
+    sn[sn < thresh] = -1
+    sn[np.arange(box.shape[1])[None, :] >= nbins[:, None]] = -1
+    return sn
@@ -0,0 +1,164 @@
+"""
+Sifting of the single pulse candidates of dv.py.
+
+One bright pulse is detected at many neighbouring DM trials, pulse widths
+and time bins.  The candidates are put on a grid in (time, DM trial,
+width) and the occupied cells that touch each other are joined into one
+cluster (a friends-of-friends with the cell size as linking length).  Each
+cluster is reported once, by its member with the highest S/N, together with
+the number of members and their extent in time, DM and width.
+
+Putting the candidates on the grid and finding the neighbouring cells
+takes a sort, so the whole stage is O(N log N) and runs on tens of millions
+of candidates.  It can be run on the candidates of one MPI process before
+anything is written, or on candidate files afterwards:
+
+    python sift.py sifted.cand ppc_SNR_pol_1_td_*.cand
+"""
+
+import sys
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import candidates
+
+# the columns of a sifted store: the peak candidate of each cluster, the number
+# of candidates in it and their range in time, DM and pulse width
+schema = candidates.schema + [('members', '<i8'), ('tmin', '<f8'), ('tmax', '<f8'), ('DMmin', '<f8'),
+                              ('DMmax', '<f8'), ('dtaumin', '<f4'), ('dtaumax', '<f4')]
+
+
+def cells(time, DM, dtau, DMtrials=None, tlink=None, dmlink=2):
+    """
+    Grid cell of every candidate.  The width level is log2 of dtau over the
+    narrowest width, rounded, and the time cells of a level are tlink*2**level
+    wide, so wider pulses link over a proportionally longer time.  DM is
+    counted in trials of DMtrials, dmlink trials per cell, so the link is the
+    same for a uniform or a geometric DM grid.
+    Required:
+    time, DM, dtau - candidate columns
+    Options:
+    DMtrials - sorted DM trials searched.  default = the distinct DMs given.
+    tlink    - time cell, in seconds, at the narrowest width.  default =
+               the narrowest dtau.
+    dmlink   - DM trials per cell.  default = 2.
+    Returns (ct, cd, cw), the integer cell coordinates.
+    """
+    dtau = np.asarray(dtau, dtype=np.float64)
+    if DMtrials is None:
+        DMtrials = np.unique(DM)
+    if tlink is None:
+        tlink = dtau.min()
+    cw = np.round(np.log2(dtau/dtau.min())).astype(np.int64)
+    center = np.asarray(time)+dtau/2.
+    ct = np.floor(center/(tlink*2.**cw)).astype(np.int64)
+    cd = np.searchsorted(DMtrials, DM)//dmlink
+    return ct, cd, cw
+
+
+def cluster(ct, cd, cw):
+    """
+    Label the candidates by cluster.  Two occupied cells are joined if they
+    are at the same width level and touch in time and DM (including
+    diagonally), or if they are at neighbouring width levels and the cell of
+    the wider level touches the one that contains the narrower cell.
+    Returns (labels, nclusters).
+    """
+    if len(ct) == 0:
+        return np.zeros(0, dtype=np.int64), 0
+
+    # pack the cells into one int64 key, with a margin of one cell on both
+    # sides of every coordinate so that the neighbours never wrap around
+    ct0, cd0, cw0 = ct.min()-2, cd.min()-1, cw.min()-1
+    nd = cd.max()-cd0+2
+    nw = cw.max()-cw0+2
+    def pack(t, d, w):
+        return ((t-ct0)*nd+(d-cd0))*nw+(w-cw0)
+
+    keys, inverse = np.unique(pack(ct, cd, cw), return_inverse=True)
+    w = keys % nw + cw0
+    d = (keys//nw) % nd + cd0
+    t = keys//(nw*nd) + ct0
+
+    rows = []
+    cols = []
+    for dd in (-1, 0, 1):
+        for dt in (-1, 0, 1):
+            # same width level, and the level above whose cells are twice as long
+            for other in (pack(t+dt, d+dd, w), pack(t//2+dt, d+dd, w+1)):
+                j = np.minimum(np.searchsorted(keys, other), len(keys)-1)
+                found = keys[j] == other
+                rows.append(np.nonzero(found)[0])
+                cols.append(j[found])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(keys), len(keys)))
+    nclusters, celllabels = connected_components(graph, directed=False)
+
+    return celllabels[inverse], nclusters
+
+
+def sift(cand, DMtrials=None, tlink=None, dmlink=2):
+    """
+    Collapse candidates into clusters.
+    Required:
+    cand - structured array with at least the fields of candidates.schema,
+           e.g. from candidates.read_candidates
+    Options:
+    DMtrials, tlink, dmlink - see cells
+    Returns a structured array with the fields of schema, one row per
+    cluster ordered by time, holding the member with the highest S/N.
+    """
+    if len(cand) == 0:
+        return np.zeros(0, dtype=schema)
+    labels, nclusters = cluster(*cells(cand['time'], cand['DM'], cand['dtau'], DMtrials, tlink, dmlink))
+
+    # members of every cluster together, the highest S/N first
+    order = np.lexsort((-cand['SNR'], labels))
+    labels = labels[order]
+    first = np.r_[0, np.nonzero(np.diff(labels))[0]+1]
+    peak = cand[order[first]]
+
+    out = np.zeros(nclusters, dtype=schema)
+    for name, dtype in candidates.schema:
+        out[name] = peak[name]
+    out['members'] = np.diff(np.r_[first, len(order)])
+    for name, column in (('t', 'time'), ('DM', 'DM'), ('dtau', 'dtau')):
+        values = cand[column][order]
+        out[name+'min'] = np.minimum.reduceat(values, first)
+        out[name+'max'] = np.maximum.reduceat(values, first)
+
+    out = out[np.argsort(out['time'], kind='mergesort')]
+    out['pulse'] = np.arange(1, nclusters+1)
+    return out
+
+
+def write_sifted(name, sifted):
+    """
+    Append sifted clusters to the store name (columns of schema).
+    """
+    writer = candidates.CandidateWriter(name, schema=schema)
+    writer.append(*[sifted[column] for column, dtype in schema[1:]])
+    writer.close()
+
+
+def main(args):
+    if len(args) < 2:
+        print 'usage: python sift.py sifted.cand ppc_SNR_*.cand|ppc_SNR_*.txt ...'
+        sys.exit(1)
+    tables = []
+    for name in args[1:]:
+        t = candidates.load_table(name)
+        table = np.zeros(len(t), dtype=candidates.schema)
+        for i, column in enumerate(candidates.columns):
+            table[column] = t[:, i]
+        tables.append(table)
+    cand = np.concatenate(tables)
+    sifted = sift(cand)
+    write_sifted(args[0], sifted)
+    print len(cand), 'candidates sifted into', len(sifted), 'clusters in', args[0]
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
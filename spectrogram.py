@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""Module for the spectrogram container of an FFT stage.  Instead of one .npy
+file per chunk, a stage (ft.py, waterfall.py, multift.py, ...) can write all
+of its chunks into one preallocated .npy file:
+
+    <data file>_<stage>.npy     (slabs*rows, 2, channels) array, one slab of
+                                 rows per chunk in offset order
+    <data file>_<stage>.json    sidecar with the layout (offsets of the
+                                 slabs, rows per slab), tInt, freq1, freq2
+                                 and the mask of the valid slabs
+
+Rank 0 creates the container, every rank writes the slabs of its chunks into
+it at their place and the readers (dv.py, interpolate.py, ...) memory map it
+and take any window of time and channels without opening one file per chunk.
+Chunks are still recorded in the run manifest of the stage (see manifest.py);
+the valid mask of the sidecar is brought up to date from the manifest at the
+end of every run.
+
+The spectra are stored with the 'precision' given when the container is made:
+'float64', 'float32', or 'uint16'/'uint8' quantized between the minimum and
+the maximum of every channel of a chunk.  The offsets and scales of the
+quantized ones go to <data file>_<stage>_scale.npy, a (slabs, 2, 2, channels)
+float32 array of (offset, scale) for each tuning and channel, and the readers
+get the spectra back as float32 through slab() and window()."""
+
+import os
+import json
+import numpy
+
+__version__ = '0.1'
+__revision__ = '$ Revision: 1 $'
+__all__ = ['SpectrogramFile', 'containerName', 'isContainer', 'create', 'openStage', 'precisions', '__version__', '__revision__', '__all__']
+
+# Storage type of every precision a container can have
+precisions = {'float64': numpy.float64, 'float32': numpy.float32, 'uint16': numpy.uint16, 'uint8': numpy.uint8}
+
+
+def containerName(filename, stage):
+	"""Return the name of the spectrogram container of 'stage' (e.g. 'ft',
+	'waterfall') run on the DRX file 'filename'."""
+
+	return "%s_%s.npy" % (filename, stage)
+
+
+def _sidecarName(name):
+	return os.path.splitext(name)[0] + '.json'
+
+
+def _scaleName(name):
+	return os.path.splitext(name)[0] + '_scale.npy'
+
+
+def _write(name, position, data):
+	# Positioned write of the bytes of 'data' into the file 'name', synced to disk
+	fh = open(name, 'r+b')
+	try:
+		fh.seek(position)
+		fh.write(numpy.ascontiguousarray(data).tostring())
+		fh.flush()
+		os.fsync(fh.fileno())
+	finally:
+		fh.close()
+
+
+def _quantize(spectra, dtype):
+	# Quantize the (rows, 2, channels) spectra to the full range of the
+	# unsigned type 'dtype' between the minimum and maximum of every channel,
+	# returns the quantized spectra and the (2, 2, channels) offsets and scales
+	levels = numpy.iinfo(dtype).max
+	low = spectra.min(0).astype(numpy.float32)
+	scale = ((spectra.max(0) - low) / levels).astype(numpy.float32)
+	scale[scale == 0] = 1.
+	quantized = numpy.clip(numpy.rint((spectra - low) / scale), 0, levels).astype(dtype)
+
+	return quantized, numpy.array([low, scale])
+
+
+def isContainer(name):
+	"""Return True if the file 'name' (e.g. the file of a manifest record) is
+	a spectrogram container, i.e. it has a sidecar."""
+
+	return os.path.exists(_sidecarName(name))
+
+
+def _writeSidecar(name, meta):
+	# Written next to the sidecar and renamed, so readers never see half of it
+	sidecar = _sidecarName(name)
+	tmpname = "%s.tmp%i" % (sidecar, os.getpid())
+	fh = open(tmpname, 'w')
+	try:
+		json.dump(meta, fh, indent=1)
+		fh.flush()
+		os.fsync(fh.fileno())
+	finally:
+		fh.close()
+	os.rename(tmpname, sidecar)
+
+
+def create(name, offsets, rowsPerSlab, nChan, tInt=None, freq1=None, freq2=None, precision='float64'):
+	"""Create the container 'name' for the chunks that start at the frames
+	'offsets', each one a slab of 'rowsPerSlab' rows of (2, nChan) spectra
+	stored with 'precision' (one of the keys of precisions), and write its
+	sidecar with all of the slabs marked as not valid.  The data file is
+	sparse until the slabs are written.  Returns a SpectrogramFile opened
+	for writing."""
+
+	if precision not in precisions:
+		raise ValueError("The precision has to be one of %s" % ', '.join(sorted(precisions)))
+	dtype = precisions[precision]
+	offsets = [int(offset) for offset in offsets]
+	shape = (len(offsets)*rowsPerSlab, 2, nChan)
+	data = numpy.lib.format.open_memmap(name, mode='w+', dtype=dtype, shape=shape)
+	del data
+	if numpy.dtype(dtype).kind == 'u':
+		scales = numpy.lib.format.open_memmap(_scaleName(name), mode='w+', dtype=numpy.float32, shape=(len(offsets), 2, 2, nChan))
+		del scales
+
+	meta = {'shape': list(shape), 'dtype': numpy.dtype(dtype).str, 'precision': precision, 'rowsPerSlab': rowsPerSlab, 'offsets': offsets,
+		'valid': [False]*len(offsets), 'tInt': tInt,
+		'freq1': None if freq1 is None else [float(f) for f in freq1],
+		'freq2': None if freq2 is None else [float(f) for f in freq2]}
+	_writeSidecar(name, meta)
+
+	return SpectrogramFile(name, mode='r+')
+
+
+def openStage(comm, name, offsets, rowsPerSlab, nChan, tInt=None, freq1=None, freq2=None, precision='float64'):
+	"""Open the container 'name' of a stage on every rank of 'comm' for
+	writing.  Rank 0 creates it unless it already exists with the same
+	layout (a rerun after a crash keeps the slabs written before); a
+	container with another layout raises a ValueError.  Returns the
+	SpectrogramFile."""
+
+	error = None
+	if comm.Get_rank() == 0:
+		if os.path.exists(name) and isContainer(name):
+			spec = SpectrogramFile(name)
+			if spec.offsets.tolist() != [int(offset) for offset in offsets] or spec.rowsPerSlab != rowsPerSlab \
+				or spec.data.shape[2] != nChan or spec.precision != precision:
+				error = "%s exists with another layout, move it away to make a new one" % name
+		else:
+			create(name, offsets, rowsPerSlab, nChan, tInt=tInt, freq1=freq1, freq2=freq2, precision=precision)
+	error = comm.bcast(error, root=0)
+	if error is not None:
+		raise ValueError(error)
+
+	return SpectrogramFile(name, mode='r+')
+
+
+class SpectrogramFile(object):
+	"""Class for the spectrogram container 'name'.  'data' is the memory
+	mapped (time, 2, channels) array as stored, read only unless 'mode' is
+	'r+', and 'offsets', 'valid', 'tInt', 'freq1', 'freq2' and 'precision'
+	come from the sidecar.  'dtype' is the type of the spectra slab() and
+	window() give, float32 unless the precision is float64."""
+
+	def __init__(self, name, mode='r'):
+		self.name = name
+		self.mode = mode
+		fh = open(_sidecarName(name))
+		try:
+			self.meta = json.load(fh)
+		finally:
+			fh.close()
+		self.data = numpy.load(name, mmap_mode='r')
+		self.rowsPerSlab = self.meta['rowsPerSlab']
+		self.offsets = numpy.array(self.meta['offsets'], dtype=numpy.int64)
+		self.valid = numpy.array(self.meta['valid'], dtype=bool)
+		self.tInt = self.meta['tInt']
+		self.freq1 = None if self.meta['freq1'] is None else numpy.array(self.meta['freq1'])
+		self.freq2 = None if self.meta['freq2'] is None else numpy.array(self.meta['freq2'])
+		self.precision = self.meta.get('precision', self.data.dtype.name)
+		self.quantized = self.data.dtype.kind == 'u'
+		self.dtype = numpy.dtype(numpy.float64 if self.precision == 'float64' else numpy.float32)
+		self.scales = numpy.load(_scaleName(name), mmap_mode='r') if self.quantized else None
+		self.nSlabs = len(self.offsets)
+		self._index = dict((offset, i) for i, offset in enumerate(self.offsets.tolist()))
+		self._slabBytes = self.rowsPerSlab*self.data.shape[1]*self.data.shape[2]*self.data.dtype.itemsize
+
+	def slabIndex(self, offset):
+		"""Return the number of the slab of the chunk starting at frame
+		'offset', a KeyError if the container has no such chunk."""
+
+		return self._index[int(offset)]
+
+	def slab(self, i):
+		"""Return the (rowsPerSlab, 2, channels) spectra of slab number 'i',
+		memory mapped unless the container is quantized."""
+
+		return self.window(i*self.rowsPerSlab, (i+1)*self.rowsPerSlab)
+
+	def window(self, tStart, tStop, chanLow=0, chanHigh=None, tuning=None):
+		"""Return the spectra of the time bins tStart through tStop-1 and the
+		channels chanLow through chanHigh-1, of both tunings or only of
+		'tuning'.  They are memory mapped unless the container is quantized,
+		then only the window is read and turned back into float32."""
+
+		tunings = slice(None) if tuning is None else tuning
+		data = self.data[tStart:tStop, tunings, chanLow:chanHigh]
+		if not self.quantized:
+			return data
+
+		# the offsets and scales of the slabs the window has, each applied to
+		# the rows of the window in its slab
+		start, stop = slice(tStart, tStop).indices(self.data.shape[0])[:2]
+		firstSlab = start / self.rowsPerSlab
+		scales = self.scales[firstSlab:max(firstSlab, -(-stop / self.rowsPerSlab))][:, :, tunings, chanLow:chanHigh]
+		spectra = data.astype(numpy.float32)
+		for i in xrange(len(scales)):
+			rows = slice(max(start, (firstSlab+i)*self.rowsPerSlab) - start, min(stop, (firstSlab+i+1)*self.rowsPerSlab) - start)
+			spectra[rows] *= scales[i, 1]
+			spectra[rows] += scales[i, 0]
+
+		return spectra
+
+	def save(self, offset, spectra):
+		"""Write the spectra of the chunk starting at frame 'offset' into its
+		slab and sync it to disk.  The write goes through the file and not
+		the memory map so ranks on different nodes of a shared file system
+		can write their slabs at the same time.  Returns the name of the
+		container, to record in the run manifest."""
+
+		if self.mode != 'r+':
+			raise IOError("%s is opened read only" % self.name)
+		shape = (self.rowsPerSlab,) + self.data.shape[1:]
+		if numpy.size(spectra) != numpy.prod(shape):
+			raise ValueError("The spectra of a chunk have to be %s, not %s" % (str(shape), str(numpy.shape(spectra))))
+		i = self.slabIndex(offset)
+
+		if self.quantized:
+			spectra, scales = _quantize(numpy.reshape(spectra, shape), self.data.dtype)
+			_write(_scaleName(self.name), self.scales.offset + i*scales.nbytes, scales)
+		else:
+			spectra = numpy.asarray(spectra, dtype=self.data.dtype)
+		_write(self.name, self.data.offset + i*self._slabBytes, spectra)
+
+		return self.name
+
+	def setValid(self, offsets):
+		"""Mark the slabs of the chunks starting at the frames 'offsets' as
+		the valid ones, all others as not valid, and rewrite the sidecar.
+		Offsets the container does not have are left out."""
+
+		self.valid[:] = False
+		for offset in offsets:
+			if int(offset) in self._index:
+				self.valid[self._index[int(offset)]] = True
+		self.meta['valid'] = self.valid.tolist()
+		_writeSidecar(self.name, self.meta)
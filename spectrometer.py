@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""Module that turns blocks of DRX frames into averaged power spectra for the
+FFT stages (ft.py, waterfall.py, ...)."""
+
+import numpy
+
+import drx
+import fftbackend
+
+__version__ = '0.1'
+__revision__ = '$ Revision: 1 $'
+__all__ = ['Spectrometer', 'MultiSpectrometer', 'channelIndex', 'channelFrequency', 'channelWindow', '__version__', '__revision__', '__all__']
+
+
+def channelIndex(LFFT, chanLow=0, chanHigh=None):
+	"""Function to build the index array that picks channels chanLow through
+	chanHigh-1 out of an unshifted LFFT-point spectrum.  This reproduces the
+	fftshift(spectrum[1:])[chanLow:chanHigh] ordering used by the original FFT
+	stages, so the DC bin is dropped and the gather replaces both the shift
+	and the slice."""
+
+	if chanHigh is None:
+		chanHigh = LFFT - 1
+
+	return numpy.fft.fftshift(numpy.arange(1, LFFT))[chanLow:chanHigh]
+
+
+def channelFrequency(LFFT, sampleRate, chanLow=0, chanHigh=None):
+	"""Function to compute the frequencies, relative to the central frequency
+	of the tuning, of the channels channelIndex picks.  The LFFT/2 bin is
+	put at +sampleRate/2 so the frequencies increase along the channels."""
+
+	index = channelIndex(LFFT, chanLow, chanHigh)
+
+	return numpy.where(index <= LFFT/2, index, index - LFFT) * float(sampleRate) / LFFT
+
+
+def channelWindow(freq, LFFT, sampleRate):
+	"""Function to find the (chanLow, chanHigh) window of an LFFT-point
+	spectrum whose channelFrequency are 'freq' (e.g. the frequencies of a
+	spectrogram container less the central frequency of the tuning).  A
+	ValueError is raised if 'freq' are not such a window."""
+
+	allFreq = channelFrequency(LFFT, sampleRate)
+	chanLow = int(numpy.argmin(numpy.abs(allFreq - freq[0])))
+	chanHigh = chanLow + len(freq)
+	if chanHigh > len(allFreq) or not numpy.allclose(allFreq[chanLow:chanHigh], freq, rtol=0, atol=0.01*sampleRate/LFFT):
+		raise ValueError("The frequencies are not a window of the channels of a %i point FFT" % LFFT)
+
+	return chanLow, chanHigh
+
+
+class Spectrometer(object):
+	"""Class that computes the power spectra of many chunks at once.  Each
+	chunk is LFFT samples of the four tuning/polarization streams (X1, Y1,
+	X2, Y2) and is reduced to a (2, channels) array holding (|X|^2+|Y|^2)/
+	LFFT/2 for the requested channel window of each tuning.  That is the same
+	quantity the per-chunk fft2 code produced, but computed with one batched
+	1-D transform along the time axis and with the buffers allocated once.
+
+	'windows' is a two-element list of (chanLow, chanHigh) pairs, one for
+	each tuning, and both windows need to have the same width.  'backend' is
+	an fftbackend object; the fastest available one is used if not given."""
+
+	def __init__(self, LFFT, windows, nBlock=64, framesPerChunk=None, backend=None):
+		self.LFFT = LFFT
+		if backend is None:
+			backend = fftbackend.getBackend()
+		self.backend = backend
+		self.nBlock = nBlock
+		self.windows = windows
+		self.chanIndex = [channelIndex(LFFT, lo, hi) for lo, hi in windows]
+		self.nChan = len(self.chanIndex[0])
+		for index in self.chanIndex:
+			if len(index) != self.nChan:
+				raise ValueError("Both tuning windows must have the same number of channels")
+
+		# The number of frames in a chunk, 4 = beampols = 2X + 2Y
+		if framesPerChunk is None:
+			framesPerChunk = 4 * LFFT / 4096
+		self.framesPerChunk = framesPerChunk
+
+		self.data = numpy.zeros((nBlock, 4, LFFT), dtype=numpy.complex64)
+
+	def computeSpectra(self, data, out=None):
+		"""Compute the spectra for a (chunks, 4, LFFT) block of time series.
+		The result is written into 'out', a (chunks, 2, channels) array,
+		which is created when not given.  Returns 'out'."""
+
+		if out is None:
+			out = numpy.zeros((data.shape[0], 2, self.nChan))
+
+		spec = self.backend.fft(data, axis=-1)
+		for tuning, index in enumerate(self.chanIndex):
+			cSpec = spec[:, 2*tuning:2*tuning+2, index]
+			power = cSpec.real**2
+			power += cSpec.imag**2
+			numpy.sum(power, axis=1, out=out[:, tuning, :])
+		out /= 2.*self.LFFT
+
+		return out
+
+	def process(self, idf, start, nChunks, out=None):
+		"""Read 'nChunks' chunks from the DRXFile 'idf' starting at frame
+		'start' and compute their spectra, nBlock chunks at a time.  Returns
+		the (nChunks, 2, channels) spectra array."""
+
+		if out is None:
+			out = numpy.zeros((nChunks, 2, self.nChan))
+
+		for i in xrange(0, nChunks, self.nBlock):
+			n = min(self.nBlock, nChunks - i)
+			cFrames, cIQ = idf.readFrames(start + i*self.framesPerChunk, n*self.framesPerChunk, dropBad=False)
+
+			data = self.data[:n]
+			data[...] = 0
+			drx.fillChunks(cFrames, cIQ, data, self.framesPerChunk)
+			self.computeSpectra(data, out=out[i:i+n])
+
+		return out
+
+
+class MultiSpectrometer(object):
+	"""Class that computes the spectra of several Spectrometer objects from a
+	single read of the data.  The frames are read in chunks of the longest
+	transform, LFFT samples, and a product with a shorter transform gets the
+	same time series cut into LFFT/product.LFFT consecutive chunks of its
+	own length.  This way a coarse full band product (e.g. the LFFT = 4096
+	spectra of waterfall.py) and a fine windowed one (the spectrogram of
+	ft.py) come out of the same frames read once.
+
+	'products' is a list of Spectrometer objects whose LFFT divides 'LFFT'."""
+
+	def __init__(self, LFFT, products, nBlock=64, framesPerChunk=None):
+		self.LFFT = LFFT
+		self.products = products
+		self.nBlock = nBlock
+		for product in products:
+			if LFFT % product.LFFT != 0:
+				raise ValueError("The transform length of every product must divide %i" % LFFT)
+
+		# The number of frames in a chunk, 4 = beampols = 2X + 2Y
+		if framesPerChunk is None:
+			framesPerChunk = 4 * LFFT / 4096
+		self.framesPerChunk = framesPerChunk
+
+		self.data = numpy.zeros((nBlock, 4, LFFT), dtype=numpy.complex64)
+		self.spectra = [numpy.zeros((nBlock*LFFT/product.LFFT, 2, product.nChan)) for product in products]
+
+	def blocks(self, idf, start, nChunks):
+		"""Generator that reads 'nChunks' chunks of LFFT samples from the
+		DRXFile 'idf' starting at frame 'start', nBlock chunks at a time.  For
+		every block it yields (i, n, spectra): the first chunk 'i' and the
+		number 'n' of chunks in the block and a list with the spectra of each
+		product, a (n*LFFT/product.LFFT, 2, channels) array in time order.
+		The arrays are reused for the next block."""
+
+		for i in xrange(0, nChunks, self.nBlock):
+			n = min(self.nBlock, nChunks - i)
+			cFrames, cIQ = idf.readFrames(start + i*self.framesPerChunk, n*self.framesPerChunk, dropBad=False)
+
+			data = self.data[:n]
+			data[...] = 0
+			drx.fillChunks(cFrames, cIQ, data, self.framesPerChunk)
+
+			spectra = []
+			for product, out in zip(self.products, self.spectra):
+				split = self.LFFT / product.LFFT
+				if split == 1:
+					pData = data
+				else:
+					# Consecutive pieces of each stream become chunks of the product
+					pData = data.reshape(n, 4, split, product.LFFT).transpose(0, 2, 1, 3).reshape(n*split, 4, product.LFFT)
+				spectra.append(product.computeSpectra(pData, out=out[:n*split]))
+
+			yield i, n, spectra
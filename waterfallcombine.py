@@ -1,18 +1,62 @@
 import glob
 import numpy as np
+import spectrogram
 
-def Decimate(ts, ndown=2):
-	#return a decimated array shape = x, y, z, ...) with shape =  x/ndown, y, z, ....
-    if ndown==1:
-       return ts
-    ncols = len(ts)
-    n_rep = ncols / ndown
-    ts_ds = np.array([ts[i::ndown][0:n_rep] for i in range(ndown)]).mean(0)
-    return ts_ds
+container = '057139_000656029_waterfall.npy' #spectrogram container of waterfall.py (spectrogram.py), None = the waterfall05*.npy file of every chunk
+nrows = 4000   #fewest rows of waterfall.npy, every ndown = nspectra/nrows spectra are averaged into one
+batch = 1024   #spectra read from the container at a time
 
-fn = sorted(glob.glob('waterfall05*.npy'))
-sp = np.zeros((len(fn),np.load(fn[0]).shape[0],np.load(fn[0]).shape[1]))
-for i in range(len(fn)):
-    sp[i,:,:]=np.load(fn[i])
+def Decimate(spectra, nspectra, ndown, outname):
+    """
+    Average every ndown consecutive spectra into one row of outname, a .npy written
+    through a memory map as the rows are done, so only one row is held in memory.
+    Gives the same rows as averaging ts[i::ndown] over i of the whole array; the last
+    nspectra % ndown spectra are left out.
+    Required:
+    spectra  - iterator over the (2, channels) spectra in time order
+    nspectra - number of spectra spectra gives
+    ndown    - spectra averaged into a row
+    outname  - name of the .npy file made
+    """
+    nout = nspectra / ndown
+    if nout == 0:
+        raise ValueError("%i spectra are too few to make a row of %s" % (nspectra, outname))
+    out  = None
+    for i, sp in enumerate(spectra):
+        if i >= nout*ndown:
+            break
+        if out is None:
+            out = np.lib.format.open_memmap(outname, mode='w+', dtype=np.float64, shape=(nout,)+sp.shape)
+            acc = np.zeros(sp.shape)
+        acc += sp
+        if i % ndown == ndown-1:
+            out[i/ndown] = acc/ndown
+            acc[...] = 0
+    out.flush()
+    return out
 
-np.save('waterfall',Decimate(sp, sp.shape[0]/4000))
+def containerspectra(spec):
+    #the spectra of the valid slabs of the container, read batch at a time from its memory map
+    #(and turned back into floats if it is quantized), the slabs that are not written are left out
+    valid = np.repeat(spec.valid, spec.rowsPerSlab)
+    for b in range(0, spec.data.shape[0], batch):
+        for sp in np.array(spec.window(b, b+batch))[valid[b:b+batch]]:
+            yield sp
+
+def filespectra(fn):
+    #the spectra of the waterfall05*.npy files, one file at a time
+    for name in fn:
+        yield np.load(name)
+
+if container is not None:
+    spec = spectrogram.SpectrogramFile(container)
+    nspectra = spec.valid.sum()*spec.rowsPerSlab
+    if not spec.valid.all():
+        print 'chunks not valid in',container,', left out:',spec.offsets[~spec.valid]
+    spectra  = containerspectra(spec)
+else:
+    fn = sorted(glob.glob('waterfall05*.npy'))
+    nspectra = len(fn)
+    spectra  = filespectra(fn)
+
+Decimate(spectra, nspectra, max(1, nspectra/nrows), 'waterfall.npy')
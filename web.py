@@ -6,41 +6,189 @@ import os
 import sys
 import glob
 import sqlite3
+import itertools
+import threading
+import collections
+import cStringIO
+
+database  = "2016.sql" #made by SQL.py
+cachesize = 64 #number of rendered plots kept in memory
+maxpoints = 100000 #queries with more candidates than this are drawn from the density tiles made by SQL.py
+maxtbins  = 1024 #most time bins of tiles across a plot
+
+local = threading.local()
+renderlock = threading.Lock() #pyplot is not thread safe
+cachelock = threading.Lock()
+cache = collections.OrderedDict()
+
+
+def connection():
+    #one connection per server thread, opened on its first query
+    if getattr(local, 'con', None) is None:
+        local.con = sqlite3.connect(database)
+    return local.con
+
+
+def query(timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
+    """
+    Candidates in the ranges, as a (n, 3) array of snr, dm, time_tag.
+    """
+    cur = connection().cursor()
+    cur.execute("SELECT snr, dm, time_tag FROM 'lwa1' WHERE (time_tag > ? and time_tag < ? and snr > ? and dm > ? and dm < ? and resolution > ? and resolution < ?)", (timeL, timeH, SNRmin, DML, DMH, resolL, resolH))
+    return np.fromiter(itertools.chain.from_iterable(cur), dtype=np.float64).reshape(-1,3)
+
+
+def tilelevel(timeL,timeH):
+    """
+    Finest tile level with at most maxtbins time bins in the time range, as (level, tbin, dmbin).
+    None if the database has no tiles.
+    """
+    try:
+        levels = connection().execute("SELECT level, tbin, dmbin FROM 'tilelevels' ORDER BY level").fetchall()
+    except sqlite3.OperationalError:
+        return None
+    for level in levels:
+        if (timeH-timeL)/level[1] <= maxtbins:
+            return level
+    return levels[-1] if len(levels) > 0 else None
+
+
+def querytiles(level,timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
+    """
+    Tiles of the level that overlap the ranges, as a (n, 6) array of time bin, DM bin, resolution,
+    S/N band, number of candidates and highest S/N.  The S/N cut is made at the lower edges of the
+    S/N bands of the tiles.
+    """
+    level, tbin, dmbin = level
+    cur = connection().cursor()
+    cur.execute("SELECT tb, db, resolution, snrlow, count, maxsnr FROM 'tiles' WHERE (level = ? and tb >= ? and tb <= ? and db >= ? and db <= ? and resolution > ? and resolution < ? and snrlow >= ?)", (level, np.floor(timeL/tbin), np.floor(timeH/tbin), np.floor(DML/dmbin), np.floor(DMH/dmbin), resolL, resolH, SNRmin))
+    return np.fromiter(itertools.chain.from_iterable(cur), dtype=np.float64).reshape(-1,6)
+
+
+def usetiles(timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
+    """
+    Tile level to draw the ranges from, or None if they hold few enough candidates to plot every one.
+    The number of candidates is counted on the coarsest tiles.
+    """
+    level = tilelevel(timeL,timeH)
+    if level is None:
+        return None
+    coarsest = connection().execute("SELECT level, tbin, dmbin FROM 'tilelevels' ORDER BY level DESC LIMIT 1").fetchone()
+    if querytiles(coarsest,timeL,timeH,SNRmin,DML,DMH,resolL,resolH)[:,4].sum() <= maxpoints:
+        return None
+    return level
+
+
+def dbversion():
+    #grows whenever SQL.py adds candidates, so the plots of an older database are not reused
+    return connection().execute("SELECT max(rowid) FROM 'lwa1'").fetchone()
+
+
+def plotpng(timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
+    """
+    PNG of guplot for the ranges, from the cache of the last cachesize plots if it was made before.
+    """
+    key = (timeL,timeH,SNRmin,DML,DMH,resolL,resolH)+dbversion()
+    with cachelock:
+        if key in cache:
+            png = cache.pop(key)
+            cache[key] = png
+            return png
+    with renderlock:
+        level = usetiles(timeL,timeH,SNRmin,DML,DMH,resolL,resolH)
+        if level is None:
+            png = guplot(timeL,timeH,SNRmin,DML,DMH,resolL,resolH)
+        else:
+            png = guplottiles(level,timeL,timeH,SNRmin,DML,DMH,resolL,resolH)
+    with cachelock:
+        cache[key] = png
+        while len(cache) > cachesize:
+            cache.popitem(last=False)
+    return png
 
-#def guplot(timeL,timeH,SNRmin,mjd,DML,DMH,resolL,resolH):
-def guplot(timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
+
+def pyplot():
     import tempfile
-    os.environ['MPLCONFIGDIR'] = tempfile.mkdtemp()    
+    if 'MPLCONFIGDIR' not in os.environ:
+        os.environ['MPLCONFIGDIR'] = tempfile.mkdtemp()
     import matplotlib as mpl
     mpl.use('Agg')
     import matplotlib.pyplot as plt
-    import numpy as np
 
     mpl.rc('xtick',labelsize=8)
     mpl.rc('ytick',labelsize=8)
+    return plt
+
+
+def guplottiles(level,timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
+    """
+    Render the candidates in the ranges from the density tiles of a level, instead of a point for
+    every candidate, and return the PNG.
+    """
+    plt = pyplot()
+    t = querytiles(level,timeL,timeH,SNRmin,DML,DMH,resolL,resolH)
+    if len(t) ==0:
+        return open('error.png',"rb").read()
+    level, tbin, dmbin = level
+    tb, db, count, maxsnr = t[:,0].astype('i8'), t[:,1].astype('i8'), t[:,4], t[:,5]
+
+    fig=plt.figure()
+    #up left#
+    fig.add_subplot(231).set_yscale('log')
+    plt.ylabel('Number of Pulses')
+    plt.xlabel('Signal to Noise')
+    bands,inverse=np.unique(t[:,3],return_inverse=True)
+    plt.step(bands,np.bincount(inverse,weights=count),where='post',color='black')
+
+    #up middle#
+    fig.add_subplot(232).set_yscale('log')
+    plt.ylabel('Number of Pulses')
+    plt.xlabel(r'DM (pc cm$^{-3}$)')
+    dms,inverse=np.unique(db,return_inverse=True)
+    plt.plot(dms*dmbin,np.bincount(inverse,weights=count),color='black')
+
+    #up right#
+    fig.add_subplot(233)
+    plt.ylabel('Signal to Noise')
+    plt.xlabel(r'DM (pc cm$^{-3}$)')
+    snrmax=np.full(len(dms),-np.inf)
+    np.maximum.at(snrmax,inverse,maxsnr)
+    plt.plot(dms*dmbin,snrmax,color='black')
+
+    #down#
+    fig.add_subplot(212)
+    plt.ylabel(r'DM (pc cm$^{-3}$)')
+    plt.xlabel('time(sec)')
+    image=np.zeros((db.max()-db.min()+1,tb.max()-tb.min()+1))
+    np.add.at(image,(db-db.min(),tb-tb.min()),count)
+    plt.imshow(np.log10(image+1),aspect='auto',origin='lower',interpolation='nearest',cmap='gray_r',
+               extent=[tb.min()*tbin,(tb.max()+1)*tbin,db.min()*dmbin,(db.max()+1)*dmbin])
+    plt.colorbar(pad=0.01).set_label('log10(Number of Pulses + 1)')
+
+    plt.suptitle('%.4f<time(s)<%.4f with SNR>%.2f, %.1f<resol(ms)<%.1f\n%i pulses in %g s x %g pc cm$^{-3}$ bins' % (timeL, timeH,SNRmin,resolL*1000,resolH*1000,count.sum(),tbin,dmbin))
+    plt.subplots_adjust(wspace=0.3)
+    buf=cStringIO.StringIO()
+    plt.savefig(buf,format='png')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+#def guplot(timeL,timeH,SNRmin,mjd,DML,DMH,resolL,resolH):
+def guplot(timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
+    """
+    Render the plots of the candidates in the ranges and return the PNG.
+    """
+    plt = pyplot()
 
 
     fftresol = 0.0020897959183673468*16
 
-    con = sqlite3.connect("2016.sql")
-    cur = con.cursor()
-    cur.execute("SELECT snr, dm, time_tag FROM 'lwa1' WHERE (time_tag> '%.3f' and time_tag< '%.3f' and snr > '%.3f' and dm > '%.4f' and dm < '%.4f' and resolution > '%.4f' and resolution < '%.4f')" %(timeL, timeH, SNRmin, DML, DMH, resolL, resolH) )
+    torg = query(timeL,timeH,SNRmin,DML,DMH,resolL,resolH)
     #cur.execute("SELECT snr, dm, time_tag FROM 'lwa1' WHERE (time_tag> '%.3f' and time_tag< '%.3f' and mjd = '%.f' and snr > '%.3f' and dm > '%.4f' and dm < '%.4f' and resolution > '%.4f' and resolution < '%.4f')" %(timeL, timeH, mjd, SNRmin, DML, DMH, resolL, resolH) )
     #cur.execute("SELECT snr, dm, time_tag FROM 'lwa1' WHERE (time_tag> '%.f' and time_tag< '%.f'  and snr > %.f)" %(timeL,timeH,SNRmin) )
-    t=np.array(cur.fetchall())
-    print t.shape,t.max(),t.min()
-    if len(t) ==0:
-        shutil.copyfile('error.png', 'image.png')
-        return
-
-    torg=np.zeros(( len(t),3))
-    for i in range(len(t)):
-        for j in range(3):
-            torg[i,j]=t[i][j]
-    #torg=np.array(cur.fetchall())
-
-    #a=[r[0] for r in cur.fetchall()]
-    #qresult = np.array(cur.fetchall())
+    if len(torg) ==0:
+        return open('error.png',"rb").read()
+    print torg.shape,torg.max(),torg.min()
 
     DMticks1=2.0   # ticks Number of DM trial in pulse number\SNR v.s. DM trial
     DMticks2=4.0   # ticks Number of DM in time v.s. DM trial
@@ -48,24 +196,14 @@ def guplot(timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
     for fname in range(1):
         DMticks3count=1
         DMticks3=1
-        t1=torg[torg[:,2].argsort()]
+        t1=torg[np.lexsort((torg[:,2],torg[:,1]))] #by DM, then time
         DMticks3count+=1
-        t1=t1[t1[:,1].argsort()]
 
-        DMtrials=np.unique(np.copy(t1.T[1]))
+        #index of every DM among the DMs recorded
+        DMtrials,dmhistorgm=np.unique(t1[:,1],return_inverse=True)
         #print 'number of DM trials recorded', DMtrials.shape
-        dmhistorgm=t1.T[1][:]*0
-        ii=0
-        for i in range(1,len(t1.T[1])):
-                if t1.T[1][i]==t1.T[1][i-1]:
-                    dmhistorgm[i]=ii
-                else:
-                    ii+=1
-                    dmhistorgm[i]=ii
-        t1=t1.T
-        t1[1]=dmhistorgm
-        t1=t1.T
-        t1=t1[t1[:,0].argsort()]
+        t1[:,1]=dmhistorgm
+        t1=t1[t1[:,0].argsort(kind='mergesort')]
         t1=t1.T
 
 
@@ -168,8 +306,10 @@ def guplot(timeL,timeH,SNRmin,DML,DMH,resolL,resolH):
         #plt.subplots_adjust(right=0.8)
         #plt.tick_params(labelsize=4)
         #plt.show()
-        plt.savefig('image')
-        return
+        buf=cStringIO.StringIO()
+        plt.savefig(buf,format='png')
+        plt.close(fig)
+        return buf.getvalue()
 
 
 render = web.template.render('templates/')
@@ -209,8 +349,8 @@ class index:
             # extracting the validated arguments from the form.
             # guplot(timeL, timeH,SNRmin,mjd)
             #guplot(float(form['time (in seconds > -1hr) Low'].value),float(form['time (in seconds <  4hr) High'].value),float(form['SNR minimum (> 5)'].value), float(form['mjd'].value), float(form['DM trials (in pc cm^-3 >  100)  Low'].value),float(form['DM trials (in pc cm^-3 < 5000) High'].value),float(form['resolL (in s >    0)  Low'].value),float(form['resolH (in s < 10.0) High'].value))
-            guplot(float(form['First time frame (in seconds >  0hr)'].value),float(form['Final time frame (in seconds <  4hr)'].value),float(form['S/N minimum (> 5)'].value), float(form['DM minimum trials (in pc cm^-3 and >    0)'].value),float(form['DM maximum trials (in pc cm^-3 and < 5000)'].value),float(form['Temporal min. decimation (in second and > 0.0)'].value),float(form['Temporal max. decimation (in second and < 10.0)'].value))
-            return open('image.png',"rb").read()
+            web.header('Content-Type', 'image/png')
+            return plotpng(float(form['First time frame (in seconds >  0hr)'].value),float(form['Final time frame (in seconds <  4hr)'].value),float(form['S/N minimum (> 5)'].value), float(form['DM minimum trials (in pc cm^-3 and >    0)'].value),float(form['DM maximum trials (in pc cm^-3 and < 5000)'].value),float(form['Temporal min. decimation (in second and > 0.0)'].value),float(form['Temporal max. decimation (in second and < 10.0)'].value))
             #return "Success! TimeL: %s, TimeH: %s, , SNR_L: %s" % (form['time (seconds) Low'].value,form['time (seconds) High'].value,form['SNR minimum'].value)
 
 if __name__=="__main__":
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Module that shares the chunks of an FFT stage (ft.py, waterfall.py, ...)
+out among the MPI ranks.  Rank 0 keeps the list of chunk offsets and hands
+them out one at a time to the other ranks as they ask for more, so fast
+nodes do more chunks than slow ones and the stage works with any number
+of ranks given to mpirun."""
+
+import collections
+import mpi4py.MPI as MPI
+
+__version__ = '0.1'
+__revision__ = '$ Revision: 1 $'
+__all__ = ['chunkOffsets', 'distribute', '__version__', '__revision__', '__all__']
+
+# Message tags
+_tagWork = 11
+_tagDone = 12
+
+
+def chunkOffsets(nFramesFile, nFrames, firstChunk=0):
+	"""Return the list of the first frames of the chunks of 'nFrames' frames
+	that fit in a file of 'nFramesFile' frames, starting with chunk number
+	'firstChunk'."""
+
+	return range(firstChunk*nFrames, nFramesFile - nFrames + 1, nFrames)
+
+
+def distribute(comm, offsets, work, prefetch=2):
+	"""Call work(offset) once for every offset in the list 'offsets', which
+	only rank 0 needs to give.  With more than one rank, rank 0 only hands
+	out offsets: every other rank gets 'prefetch' of them to start with and
+	one more each time it finishes one, so it never waits for its next
+	offset.  With a single rank, rank 0 does all the work itself.  Returns
+	the list of the offsets done by this rank."""
+
+	rank = comm.Get_rank()
+	size = comm.Get_size()
+	done = []
+
+	if size == 1:
+		for offset in offsets:
+			work(offset)
+			done.append(offset)
+		return done
+
+	if rank == 0:
+		queue = collections.deque(offsets)
+		finished = [False]*size
+		pending = 0
+		for worker in xrange(1, size):
+			for i in xrange(prefetch):
+				if len(queue) == 0:
+					break
+				comm.send(queue.popleft(), dest=worker, tag=_tagWork)
+				pending += 1
+		while pending > 0:
+			worker = comm.recv(source=MPI.ANY_SOURCE, tag=_tagDone)
+			pending -= 1
+			if len(queue) > 0:
+				comm.send(queue.popleft(), dest=worker, tag=_tagWork)
+				pending += 1
+			elif not finished[worker]:
+				comm.send(None, dest=worker, tag=_tagWork)
+				finished[worker] = True
+		for worker in xrange(1, size):
+			if not finished[worker]:
+				comm.send(None, dest=worker, tag=_tagWork)
+	else:
+		while True:
+			offset = comm.recv(source=0, tag=_tagWork)
+			if offset is None:
+				break
+			work(offset)
+			done.append(offset)
+			comm.send(rank, dest=0, tag=_tagDone)
+
+	return done